@@ -0,0 +1,231 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import Queue
+import socket
+import httplib
+import logging
+import threading
+import xmlrpclib
+
+import api
+
+"""
+Every GSMWS site keeps its own gsmws.db, but sites near each other share
+spectrum. The aggregator polls the occupancy endpoint of many gsmwsd nodes
+(see api.BTSService.occupancy), merges what they've seen into one regional
+map, and serves that back to controllers so they can pick channels nobody in
+the region is using.
+
+Polling is incremental: each node hands back a sequence number and we only
+ask for what's changed since then. A fixed pool of worker threads does the
+polling, each node keeps its own persistent connection, and every request has
+a timeout; nodes that keep failing are backed off so a few dead sites can't
+slow down a sweep of hundreds.
+"""
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """ xmlrpclib.Transport with a socket timeout. Reuses its connection. """
+    def __init__(self, timeout, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
+
+class Node(object):
+    """ One gsmwsd we poll, and what we know about it. """
+    def __init__(self, url, timeout=2.0):
+        self.url = url
+        self.proxy = xmlrpclib.ServerProxy(url, transport=TimeoutTransport(timeout),
+                                           allow_none=True)
+        self.epoch = None
+        self.seq = 0
+        self.last_ok = None
+        self.failures = 0
+        self.next_poll = 0 # don't poll before this (backoff)
+        self.busy = False # a worker is talking to it right now
+
+    def poll(self):
+        return self.proxy.occupancy(self.seq, self.epoch)
+
+    def reset(self):
+        # the cached connection is probably dead, get a new one next time
+        self.proxy("close")()
+
+class Aggregator(object):
+    """
+    Merges per-node occupancy into a regional availability map. An ARFCN is
+    safe if every node that has observed it saw an RSSI below threshold.
+    """
+    def __init__(self, urls, workers=32, timeout=2.0, threshold=0,
+                 max_backoff=300):
+        self.nodes = [Node(url, timeout) for url in urls]
+        self.workers = workers
+        self.threshold = threshold
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.observations = {} # arfcn -> {node url: (rssi, timestamp)}
+        self.version = 0 # bumped whenever the map changes
+        self.changed = {} # arfcn -> version it last changed in
+
+        self.queue = Queue.Queue()
+        self.threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            node, done = self.queue.get()
+            try:
+                self._poll_node(node)
+            finally:
+                node.busy = False
+                done()
+                self.queue.task_done()
+
+    def _poll_node(self, node):
+        try:
+            update = node.poll()
+        except (socket.error, httplib.HTTPException, xmlrpclib.Error) as e:
+            node.failures += 1
+            backoff = min(self.max_backoff, 2 ** node.failures)
+            node.next_poll = time.time() + backoff
+            node.reset()
+            logging.info("Aggregator: %s failed (%s), backing off %ds"
+                         % (node.url, e, backoff))
+            return
+        node.failures = 0
+        node.last_ok = time.time()
+        self.merge(node, update)
+
+    def merge(self, node, update):
+        """ Fold one node's occupancy update into the regional map. """
+        with self.lock:
+            self.version += 1
+            touched = set()
+            if update["full"] or update["epoch"] != node.epoch:
+                # start over for this node
+                for arfcn, seen in self.observations.items():
+                    if node.url in seen:
+                        del seen[node.url]
+                        touched.add(arfcn)
+            for arfcn, entry in update["arfcns"].items():
+                arfcn = int(arfcn)
+                self.observations.setdefault(arfcn, {})[node.url] = (entry["rssi"], entry["timestamp"])
+                touched.add(arfcn)
+            for arfcn in update["removed"]:
+                seen = self.observations.get(int(arfcn), {})
+                if node.url in seen:
+                    del seen[node.url]
+                    touched.add(int(arfcn))
+            for arfcn in touched:
+                self.changed[arfcn] = self.version
+                if not self.observations.get(arfcn):
+                    self.observations.pop(arfcn, None)
+            node.epoch = update["epoch"]
+            node.seq = update["seq"]
+
+    def poll_once(self, deadline=None):
+        """
+        Poll every node that isn't backed off, in parallel. Returns once they
+        have all answered or failed, or at deadline (seconds from now).
+        """
+        now = time.time()
+        # skip nodes still busy from a previous sweep that hit its deadline
+        due = [n for n in self.nodes if n.next_poll <= now and not n.busy]
+        if len(due) == 0:
+            return 0
+        remaining = [len(due)]
+        finished = threading.Event()
+        count_lock = threading.Lock()
+        def done():
+            with count_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+        for node in due:
+            node.busy = True
+            self.queue.put((node, done))
+        finished.wait(deadline)
+        return len(due) - remaining[0]
+
+    def _summary(self, arfcn):
+        seen = self.observations.get(arfcn, {})
+        rssis = [rssi for rssi, _ in seen.values()]
+        return {"max_rssi": max(rssis) if rssis else None,
+                "observers": len(seen),
+                "last_seen": max([ts for _, ts in seen.values()]) if seen else None,
+                "safe": len(rssis) > 0 and max(rssis) < self.threshold}
+
+    def availability(self, since=0):
+        """
+        The regional map, {arfcn: summary}, limited to ARFCNs that changed after
+        map version since. ARFCNs nobody observes any more show up as None.
+        """
+        with self.lock:
+            arfcns = [a for a, v in self.changed.items() if v > since]
+            result = {}
+            for arfcn in arfcns:
+                if arfcn in self.observations:
+                    result[str(arfcn)] = self._summary(arfcn)
+                else:
+                    result[str(arfcn)] = None
+            return {"version": self.version, "arfcns": result}
+
+    def safe_arfcns(self):
+        with self.lock:
+            return sorted([a for a in self.observations if self._summary(a)["safe"]])
+
+    def node_status(self):
+        return [{"url": n.url, "seq": n.seq, "epoch": n.epoch,
+                 "last_ok": n.last_ok, "failures": n.failures}
+                for n in self.nodes]
+
+    def run(self, interval=10, deadline=None):
+        """ Poll forever, every interval seconds. """
+        if deadline is None:
+            deadline = interval
+        while True:
+            start = time.time()
+            polled = self.poll_once(deadline)
+            logging.debug("Aggregator: polled %d nodes in %.2fs"
+                          % (polled, time.time() - start))
+            time.sleep(max(0, interval - (time.time() - start)))
+
+class AggregatorService(object):
+    """ What controllers see: the regional map, over XML-RPC. """
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    def availability(self, since=0):
+        return self.aggregator.availability(since)
+
+    def safe_arfcns(self):
+        return self.aggregator.safe_arfcns()
+
+    def nodes(self):
+        return self.aggregator.node_status()
+
+def serve(aggregator, host="localhost", port=8100, interval=10):
+    """ Poll in the background and serve the map until interrupted. """
+    poller = threading.Thread(target=aggregator.run, args=(interval,))
+    poller.daemon = True
+    poller.start()
+
+    server = api.ThreadedXMLRPCServer((host, port))
+    server.register_instance(AggregatorService(aggregator))
+    logging.info("Aggregator for %d nodes listening on %s:%d"
+                 % (len(aggregator.nodes), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,307 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+import SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+import profiling
+
+"""
+The gsmwsd API. The original gsmwsd just registered a BTS with a plain
+SimpleXMLRPCServer, which handles one request at a time: one slow command() or
+restart() and everyone else waits, and every read is a NodeManager round trip.
+
+ThreadedXMLRPCServer handles each connection in its own thread. BTSService
+wraps a BTS so that reads run in parallel (and the common ones come from a
+short-lived snapshot cache), while anything that changes the BTS is serialized
+through a per-BTS lock and flushes the cache. The reads still take turns on the
+wire: the BTS has a single NodeManager connection, guarded by its own lock (see
+BTS._read_config), so the parallelism is in the cache and everything else. Both support system.multicall so
+a dashboard can grab everything it wants in one round trip.
+
+ControlService is the same kind of server, but run from inside a controller
+(serve_control), for changing its settings on the fly. Profiling lives there
+too: gsmwsd is a separate process with no decoder threads, so profiling it
+tells you nothing about the controller.
+"""
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, **kwargs):
+        kwargs.setdefault('logRequests', False)
+        kwargs.setdefault('allow_none', True)
+        SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+        self.register_multicall_functions()
+        self.register_introspection_functions()
+
+class SnapshotCache(object):
+    """
+    Caches the result of expensive reads for ttl seconds. If several threads
+    ask for the same stale value at once, only one of them goes and gets it.
+    """
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {} # name -> (expires, value)
+        self.fetching = {} # name -> lock held while someone refreshes it
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, fn):
+        now = time.time()
+        with self.lock:
+            if name in self.values and self.values[name][0] > now:
+                self.hits += 1
+                return self.values[name][1]
+            fetch_lock = self.fetching.setdefault(name, threading.Lock())
+
+        with fetch_lock:
+            # someone else may have refreshed it while we waited
+            with self.lock:
+                if name in self.values and self.values[name][0] > time.time():
+                    self.hits += 1
+                    return self.values[name][1]
+                self.misses += 1
+            value = fn()
+            with self.lock:
+                self.values[name] = (time.time() + self.ttl, value)
+            return value
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.values.clear()
+            else:
+                self.values.pop(name, None)
+
+class OccupancyLog(object):
+    """
+    Per-ARFCN occupancy for this node, with a sequence number bumped every
+    time an ARFCN's entry changes, so an aggregator can ask "what's changed
+    since seq N?" instead of pulling everything. The epoch changes whenever
+    we restart (and our sequence numbers start over).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = "%d.%d" % (os.getpid(), int(time.time() * 1000))
+        self.seq = 0
+        self.entries = {} # arfcn -> {"rssi", "timestamp", "seq"}
+        self.removed = {} # arfcn -> seq when it went away
+
+    def update(self, observations):
+        """ observations: {arfcn: (rssi, timestamp)}, the complete current set. """
+        with self.lock:
+            for arfcn, (rssi, timestamp) in observations.items():
+                old = self.entries.get(arfcn)
+                if old is not None and old["rssi"] == rssi and old["timestamp"] == timestamp:
+                    continue
+                self.seq += 1
+                self.entries[arfcn] = {"rssi": rssi, "timestamp": timestamp,
+                                       "seq": self.seq}
+                self.removed.pop(arfcn, None)
+            for arfcn in [a for a in self.entries if a not in observations]:
+                self.seq += 1
+                del self.entries[arfcn]
+                self.removed[arfcn] = self.seq
+
+    def since(self, seq, epoch=None):
+        """
+        Everything that changed after seq. If epoch isn't ours, the caller's
+        seq means nothing to us, so they get the full set.
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                seq = 0
+            return {"epoch": self.epoch,
+                    "seq": self.seq,
+                    "full": seq == 0,
+                    "arfcns": dict((str(a), e) for a, e in self.entries.items()
+                                   if e["seq"] > seq),
+                    "removed": [a for a, s in self.removed.items() if s > seq]}
+
+def _stringify_keys(d):
+    # XML-RPC structs need string keys, and our dicts are keyed on ARFCN
+    return dict((str(k), v) for k, v in d.items())
+
+class BTSService(object):
+    """
+    Exposes a BTS over XML-RPC. Any public BTS method can be called; the ones
+    in READ_METHODS run concurrently, everything else is a mutation and runs
+    one at a time.
+    """
+    # served from the snapshot cache
+    CACHED_METHODS = ["current_arfcn", "txatten", "safe_arfcns", "statistics"]
+    # don't change anything, so don't need the mutation lock
+    READ_METHODS = CACHED_METHODS + ["is_off", "offset_correct", "reports", "occupancy"]
+    # implemented here rather than on the BTS
+    SERVICE_METHODS = CACHED_METHODS + ["occupancy", "reports"]
+
+    def __init__(self, bts, gsmwsdb=None, ttl=2.0):
+        self.bts = bts
+        self.gsmwsdb_location = gsmwsdb
+        self.cache = SnapshotCache(ttl)
+        self.mutation_lock = threading.Lock()
+        # one cursor per consumer in the ring, and a cursor isn't safe to
+        # read from two request threads at once
+        self.reports_lock = threading.Lock()
+        self.calls = 0
+        self.occupancy_log = OccupancyLog()
+
+    def safe_arfcns(self):
+        """ ARFCNs in gsmws.db which probably have no other users. """
+        if self.gsmwsdb_location is None:
+            return []
+        db = sqlite3.connect(self.gsmwsdb_location)
+        try:
+            res = db.execute("SELECT ARFCN FROM AVAIL_ARFCN WHERE RSSI < 0")
+            return sorted([r[0] for r in res.fetchall()])
+        finally:
+            db.close()
+
+    def _observations(self):
+        if self.gsmwsdb_location is None:
+            return {}
+        db = sqlite3.connect(self.gsmwsdb_location)
+        try:
+            res = db.execute("SELECT ARFCN, RSSI, TIMESTAMP FROM AVAIL_ARFCN")
+            return dict((r[0], (r[1], str(r[2]))) for r in res.fetchall())
+        finally:
+            db.close()
+
+    def occupancy(self, since=0, epoch=None):
+        """
+        Per-ARFCN occupancy from gsmws.db that changed after sequence number
+        since (see OccupancyLog). This is what the aggregator polls.
+        """
+        self.cache.get("occupancy", lambda: self.occupancy_log.update(self._observations()))
+        return self.occupancy_log.since(since, epoch)
+
+    def reports(self, consumer="api"):
+        """
+        Reports consumer hasn't seen yet. Remote readers get their own cursor
+        in the decoder's ReportRing, separate from the controller's.
+
+        Only a BTS with a decoder attached has any. gsmwsd's doesn't (the
+        controller runs the decoders, in its own process), so there this is
+        always empty.
+        """
+        if self.bts.decoder is None:
+            return []
+        with self.reports_lock:
+            reports = self.bts.reports(consumer)
+        return [_stringify_keys(r) for r in reports]
+
+    def statistics(self):
+        """
+        Request and cache counts, plus what the decoder knows if the BTS has
+        one attached (not under gsmwsd; see reports()). Reading them doesn't
+        change anything.
+        """
+        stats = {"calls": self.calls,
+                 "cache_hits": self.cache.hits,
+                 "cache_misses": self.cache.misses,
+                 "restarting": self.bts.restarting}
+        decoder = self.bts.decoder
+        if decoder is not None:
+            stats["msgs_seen"] = decoder.msgs_seen
+            stats["decoder_arfcn"] = decoder.current_arfcn
+            stats["neighbors"] = list(decoder.last_arfcns)
+            stats["parse_cache"] = decoder.parse_cache.stats()
+            stats["report_ring"] = decoder.reports.stats()
+            stats["cochannel"] = decoder.cochannel.stats()
+            stats["rssi"] = _stringify_keys(decoder.averages())
+        return stats
+
+    def _lookup(self, method):
+        if method.startswith("_"):
+            raise AttributeError("%s is private" % method)
+        if method in BTSService.SERVICE_METHODS:
+            return getattr(self, method)
+        return getattr(self.bts, method)
+
+    def _dispatch(self, method, params):
+        self.calls += 1
+        fn = self._lookup(method)
+        if method in BTSService.CACHED_METHODS:
+            return self.cache.get(method, lambda: fn(*params))
+        if method in BTSService.READ_METHODS:
+            return fn(*params)
+
+        with self.mutation_lock:
+            try:
+                return fn(*params)
+            finally:
+                self.cache.invalidate()
+
+class ControlService(object):
+    """
+    Runs inside a controller rather than gsmwsd, so it can change how the
+    controller runs without restarting it (see reconfig.py).
+    """
+    def __init__(self, reconfigurator):
+        self.reconfig = reconfigurator
+
+    def configuration(self):
+        """ The settings the controller is running with now. """
+        return self.reconfig.configuration()
+
+    def reconfigure(self, settings):
+        """
+        Change some settings (a struct, e.g. {"sleep": 5}) at the next tick.
+        Returns the complete new settings; a Fault if they don't validate.
+        """
+        return self.reconfig.submit(settings, source="control API")
+
+    def reload(self):
+        """ Re-read the config file, like SIGHUP. """
+        return self.reconfig.reload()
+
+    def reconfig_stats(self):
+        return self.reconfig.stats()
+
+    def profile(self, duration=30):
+        """ Start a sampling profile of the controller, decoder threads and
+        all (see profiling.py). Returns where the output will go, or None if
+        one's already running. """
+        return profiling.start_profile(duration)
+
+    def timers(self):
+        """ The controller's always-on timers. """
+        return profiling.timers.snapshot()
+
+def serve_control(reconfigurator, host="localhost", port=8001):
+    """ Serve a ControlService from a background thread. Returns the server. """
+    server = ThreadedXMLRPCServer((host, port))
+    server.register_instance(ControlService(reconfigurator))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    logging.info("Control API listening on %s:%d" % (host, port))
+    return server
+
+def serve(bts, host="localhost", port=8000, threaded=True, gsmwsdb=None,
+          ttl=2.0):
+    """
+    Serve bts over XML-RPC until interrupted. With threaded=False this is the
+    old single-threaded gsmwsd.
+    """
+    if threaded:
+        server = ThreadedXMLRPCServer((host, port))
+        server.register_instance(BTSService(bts, gsmwsdb=gsmwsdb, ttl=ttl))
+    else:
+        server = SimpleXMLRPCServer((host, port))
+        server.register_instance(bts)
+    logging.info("gsmwsd listening on %s:%d (threaded=%s)"
+                 % (host, port, threaded))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
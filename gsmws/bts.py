@@ -2,7 +2,10 @@
 This file is part of GSMWS.
 """
 
+import os
 import datetime
+import tempfile
+import collections
 import sqlite3
 import logging
 import threading
@@ -10,24 +13,107 @@ import envoy
 import openbts
 import random
 import decoder
+import cmdsocket
+import neighbortable
+import restart
+import profiling
+
+C0_FILE = '/var/run/c0file.txt'
+
+def parse_timestamp(ts):
+    """ Parse a TIMESTAMP from gsmws.db (sqlite stores datetimes as text). """
+    try:
+        return datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        return datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+
+class ConfigTransaction(object):
+    """
+    Collects the settings we want a BTS to have and, on commit, applies only
+    the ones that differ from what we last applied. Use it as a context
+    manager; the transaction commits if the block finishes without raising.
+
+        with bts.transaction() as t:
+            t.set_c0(51)
+            t.set_neighbors("127.0.0.10:16001 127.0.0.11:16001")
+            t.write_file(bts.C0_FILE, "51\n")
+    """
+    def __init__(self, bts):
+        self.bts = bts
+        self.config = collections.OrderedDict()
+        self.txatten = None
+        self.files = collections.OrderedDict()
+
+    def set_config(self, key, value):
+        self.config[key] = str(value)
+
+    def set_neighbors(self, neighbor_string):
+        self.set_config("GSM.Neighbors", neighbor_string)
+
+    def set_c0(self, arfcn):
+        self.set_config("GSM.Radio.C0", arfcn)
+
+    def set_txatten(self, value):
+        self.txatten = int(value)
+
+    def write_file(self, path, content):
+        self.files[path] = content
+
+    def commit(self):
+        return self.bts.apply_transaction(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        return False
 
 class BTS(object):
     """
     Provides access to handover and power related settings on a single, local
     OpenBTS instance.
     """
-    def __init__(self, loglvl=logging.DEBUG):
-        self.node_manager = openbts.OpenBTS()
-        self.cmd_socket = ('/var/run/command');
+    def __init__(self, loglvl=logging.DEBUG, cmd_socket='/var/run/command',
+                 c0_freshness=24*60*60, c0_fallback='oldest',
+                 restart_cmd="sudo supervisorctl restart openbts",
+                 restart_timeout=90, node_manager_address=None):
+        # NodeManager talks over a zmq REQ socket, which is strictly
+        # send-then-receive and can't be shared between threads; the API
+        # server, the controller and the restart prober all use this one, so
+        # every call goes through node_manager_lock (see _read_config).
+        # node_manager_address is only needed when there's more than one
+        # OpenBTS on this host (the default is OpenBTS's own, port 45060).
+        if node_manager_address is None:
+            self.node_manager = openbts.OpenBTS()
+        else:
+            self.node_manager = openbts.OpenBTS(address=node_manager_address)
+        self.node_manager_address = node_manager_address
+        self.node_manager_lock = threading.Lock()
+        self.cmd_socket = cmd_socket
+        self.cli = cmdsocket.CommandSocket(self.cmd_socket)
 
-        neighbor_table_loc = (self.node_manager
-                                .read_config("Peering.NeighborTable.Path")
-                                .data['value'])
+        neighbor_table_loc = self._read_config("Peering.NeighborTable.Path")
 
-        self.neighbor_table = sqlite3.connect(neighbor_table_loc)
+        self.neighbor_table = neighbortable.NeighborTableWriter(neighbor_table_loc)
         self.neighbors = []
         self.loglvl = loglvl
 
+        # what we last successfully applied, so we only push changes
+        self.config_lock = threading.Lock()
+        self.applied_config = {}
+        self.applied_txatten = None
+        self.applied_files = {}
+
+        # we don't rescan a C0 observed within the last c0_freshness seconds,
+        # unless c0_fallback says so (see select_c0_candidates)
+        self.c0_freshness = c0_freshness
+        self.c0_fallback = c0_fallback
+
+        self.restart_cmd = restart_cmd
+        self.restarter = restart.RestartOrchestrator(self, timeout=restart_timeout)
+
         self.decoder = None;
         self.gsmwsdb_lock = threading.Lock()
         #self.decoder = decoder.GSMDecoder()
@@ -42,25 +128,49 @@ class BTS(object):
         self.decoder = gsm_decoder
         self.decoder.start()
 
+    def _read_config(self, key):
+        """ One NodeManager read, holding node_manager_lock. """
+        with self.node_manager_lock:
+            return self.node_manager.read_config(key).data['value']
+
+    def _update_config(self, key, value):
+        """ One NodeManager write, holding node_manager_lock. """
+        with self.node_manager_lock:
+            return self.node_manager.update_config(key, value)
+
+    def txatten(self):
+        """
+        The configured txatten, according to OpenBTS.
+        """
+        return int(self._read_config('TRX.TxAttenOffset'))
+
     def is_off(self):
         """
         We define the BTS as off if it's in txatten is > 90
         """
-        txatten = int(self.node_manager
-                    .read_config('TRX.TxAttenOffset').data['value'])
-        return txatten > 90
+        return self.txatten() > 90
 
     def current_arfcn(self):
         """
         Check for the current ARFCN in use, according to OpenBTS.
         """
-        return int(self.node_manager.read_config("GSM.Radio.C0").data['value'])
+        return int(self._read_config("GSM.Radio.C0"))
+
+    def bsic(self):
+        """
+        Our BSIC (NCC * 8 + BCC, like phones report it), according to OpenBTS.
+        """
+        ncc = int(self._read_config("GSM.Identity.BSIC.NCC"))
+        bcc = int(self._read_config("GSM.Identity.BSIC.BCC"))
+        return ncc * 8 + bcc
 
-    def reports(self):
+    def reports(self, consumer="default"):
         """
-        Gets all the reports from the decoder.
+        Gets the reports from the decoder that consumer hasn't seen yet. Each
+        consumer has its own cursor (see ringbuffer.py), so reading doesn't
+        take reports away from anyone else.
         """
-        return self.decoder.reports.getall()
+        return self.decoder.reports.cursor(consumer).reports()
 
     def offset_correct(self):
         """ We need to make sure the offset for the radio is set correctly,
@@ -70,7 +180,8 @@ class BTS(object):
         # this works because the "default" offset is defined by the setting in
         # the radio's firmware; if the value in the DB is different from the
         # offset, it won't be set to default.
-        offset = self.node_manager.read_config("TRX.RadioFrequencyOffset")
+        with self.node_manager_lock:
+            offset = self.node_manager.read_config("TRX.RadioFrequencyOffset").data
         return offset['defaultValue'] == offset['value']
 
 
@@ -82,38 +193,114 @@ class BTS(object):
             Raises a ValueError if failure (probably*)
 
         * We say probably because there's no good way to know if a command sent
-        through OpenBTSDo succeeds or not! WHY WOULD YOU NEED THAT.
+        to the command socket succeeds or not! WHY WOULD YOU NEED THAT.
         """
-
-        # THIS IS THE OFFICIAL WAY TO DO THIS
-        # IN THE NAME OF ALL THAT IS HOLY
-        r = envoy.run("echo '%s' | sudo /OpenBTS/OpenBTSDo %s"
-                        % (command_str, self.cmd_socket))
-
-        # More fun: always exits with status 0! So we have to check contents of
-        # stdout for "known" error messages from OpenBTS (CLI/CLI.cpp) to guess
-        # if the command succeeded or failed. These are not guaranteed to be in
-        # output, so just a guess.
-        failure_messages = ["wrong number of arguments",
-                            "bad argument(s)",
-                            "command not found",
-                            "too many arguments for parser",
-                            "command failed"]
-        response = r.std_out.strip()
-        for msg in failure_messages:
-            if msg in response:
-                raise ValueError("%s: %s" % (msg, response))
-        return response
+        # We used to do this through OpenBTSDo (THE OFFICIAL WAY), but forking
+        # a shell, sudo and OpenBTSDo for every txatten change is way too slow.
+        # Instead we talk to the command socket ourselves; see cmdsocket.py.
+        #
+        # More fun: OpenBTS never tells us if a command failed, so we check the
+        # response for "known" error messages from OpenBTS (CLI/CLI.cpp) to
+        # guess. CommandError is a ValueError, so callers don't have to care.
+        return self.cli.command(command_str)
 
 
     def restart(self):
         """
         Restarts the BTS. Note that OpenBTS must be running as a supervisorctl
-        job.
+        job. This blocks until supervisorctl returns, which is NOT the same as
+        OpenBTS being ready; use restart_async() from the controller.
         """
         logging.warning("Restarting openbts")
-        envoy.run("sudo supervisordctl restart openbts")
+        envoy.run(self.restart_cmd)
+        self.restarted()
+
+    def restarted(self):
+        """ Forget anything OpenBTS doesn't keep across a restart. """
+        # txatten isn't persisted, so OpenBTS comes back with the configured
+        # value rather than whatever we last set.
+        with self.config_lock:
+            self.applied_txatten = None
+
+    def restart_async(self, expected_arfcn=None):
+        """
+        Restart in the background (see restart.RestartOrchestrator). Reports
+        are dropped until OpenBTS is back on expected_arfcn, or until
+        restart_timeout runs out.
+
+        Returns:
+            False if we're already restarting, True otherwise.
+        """
+        return self.restarter.restart(expected_arfcn)
+
+    @property
+    def restarting(self):
+        return self.restarter.restarting
+
+    def transaction(self):
+        """ Start a new ConfigTransaction against this BTS. """
+        return ConfigTransaction(self)
 
+    def _write_file(self, path, content):
+        """ Atomically replace path with content (write a temp file, rename). """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                        prefix=".%s." % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def apply_transaction(self, transaction):
+        """
+        Diff the transaction against what we last applied and push only the
+        changed settings to OpenBTS, in one pass. The first time we see a
+        config key we read its current value so we don't rewrite something
+        OpenBTS already has.
+
+        Returns:
+            A list of the config keys and files that were actually changed.
+            Raises openbts.exceptions.InvalidRequestError if OpenBTS rejects a
+            setting; anything applied before that is remembered.
+        """
+        changed = []
+        with self.config_lock:
+            for key, value in transaction.config.items():
+                if key not in self.applied_config:
+                    current = self._read_config(key)
+                    self.applied_config[key] = str(current)
+                if self.applied_config[key] == value:
+                    continue
+                try:
+                    self._update_config(key, value)
+                except openbts.exceptions.InvalidResponseError:
+                    # OpenBTS says it already had this value
+                    logging.debug("%s unchanged" % key)
+                self.applied_config[key] = value
+                changed.append(key)
+
+            if (transaction.txatten is not None
+                    and transaction.txatten != self.applied_txatten):
+                self.command("txatten %d" % transaction.txatten)
+                self.applied_txatten = transaction.txatten
+                changed.append("txatten")
+
+            for path, content in transaction.files.items():
+                if path not in self.applied_files and os.path.exists(path):
+                    with open(path) as f:
+                        self.applied_files[path] = f.read()
+                if self.applied_files.get(path) == content:
+                    continue
+                self._write_file(path, content)
+                self.applied_files[path] = content
+                changed.append(path)
+
+        if changed:
+            logging.info("Applied config changes: %s" % changed)
+        return changed
 
     def set_txatten(self, value):
         """ Sets the txatten value. Takes effect immediately.
@@ -122,71 +309,109 @@ class BTS(object):
             value: attenuation in dB w.r.t. full power (100mW = 20dBm)
 
         Returns:
-            response to command, or raises ValueError if invalid setting
+            True if we had to change it (False if it was already set), or
+            raises ValueError if invalid setting
 
         """
-        self.command("txatten %d" % (value))
+        t = self.transaction()
+        t.set_txatten(value)
+        return "txatten" in t.commit()
 
 
     def change_arfcn(self, new_arfcn, immediate=False):
         """ Change OpenBTS to use a new ARFCN. By default, just update the DB, but
-        don't actually restart OpenBTS. If immediate=True, restart OpenBTS too. """
+        don't actually restart OpenBTS. If immediate=True, restart OpenBTS too,
+        and return False if that didn't start (because it already was). """
         try:
-            self.node_manager.update_config("GSM.Radio.C0", new_arfcn)
+            with self.transaction() as t:
+                t.set_c0(new_arfcn)
         except openbts.exceptions.InvalidRequestError:
             return False
         logging.warning("Updated ARFCN to %s" % new_arfcn)
         if immediate:
-            # this is a blocking call
-            self.restart()
+            # doesn't block; we'll drop reports until it's back on new_arfcn
+            return self.restart_async(int(new_arfcn))
         return True
 
-    def get_random_c0s(self, gsmws_db, c0s):
-        logging.info("In get random c0s")
-        chosen_c0s = []
-        #random_c0s = random.sample(xrange(1, 124), 5)
-        #random_c0s = [1, 2, 3, 4, 5, 41, 42, 43, 44, 45, 81, 82, 83, 84, 85]
-        random_c0s = c0s;
-        logging.info("Channels %s" % random_c0s)
+    def select_c0_candidates(self, gsmws_db, c0s, now=None):
+        """
+        Pick which of c0s to put in the C0 file. We want the ones we haven't
+        observed in the last self.c0_freshness seconds (or ever). We grab the
+        last observation time for every candidate in one query and filter
+        here, so this takes the same time however many candidates we have.
+
+        If every candidate is fresh, self.c0_fallback decides what happens:
+            'oldest': use the least recently observed half of the candidates
+            'all':    use all of them anyway
+            'none':   give up and return an empty list
+
+        Returns:
+            A list of ARFCNs, in the same order as c0s.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        c0s = list(c0s)
+        if len(c0s) == 0:
+            return []
+
+        query = ("SELECT ARFCN, MAX(TIMESTAMP) FROM AVAIL_ARFCN WHERE ARFCN IN "
+                 "(%s) GROUP BY ARFCN" % ",".join(["?"] * len(c0s)))
         with self.gsmwsdb_lock:
-            available_arfcns = (gsmws_db.execute("SELECT ARFCN FROM AVAIL_ARFCN").fetchall())
+            last_seen = dict(gsmws_db.execute(query, c0s).fetchall())
 
-            if len(available_arfcns) == 0:
-                logging.info("No available_arfcns yet")
-                for c0 in random_c0s:
-                    chosen_c0s.append(c0)
+        ages = {}
+        for c0 in c0s:
+            if c0 in last_seen:
+                age = now - parse_timestamp(last_seen[c0])
+                ages[c0] = age.days * 86400 + age.seconds
             else:
-                logging.info("Available_arfcns present")
-                for c0 in random_c0s:
-                    if c0 not in available_arfcns:
-                        chosen_c0s.append(c0)
-                    else:
-                        c0_timestamp = (gsmws_db.execute("SELECT TIMESTAMP FROM AVAIL_ARFCN WHERE ARFCN=?", c0))
-                        time_difference = (datetime.datetime.now - c0_timestamp)
-                        hour_difference = time_difference.seconds / 60 / 60
-                        logging.info("Hour difference %s" % hour_difference)
-                        if hour_difference > 24:
-                            chosen_c0s.append(c0) 
-
-       
+                ages[c0] = None # never observed
+
+        chosen = [c0 for c0 in c0s
+                  if ages[c0] is None or ages[c0] > self.c0_freshness]
+        if len(chosen) > 0:
+            return chosen
+
+        logging.info("All candidate C0s seen in the last %ds, fallback=%s"
+                     % (self.c0_freshness, self.c0_fallback))
+        if self.c0_fallback == 'all':
+            return c0s
+        elif self.c0_fallback == 'oldest':
+            oldest = sorted(c0s, key=lambda c0: ages[c0], reverse=True)
+            oldest = set(oldest[:max(1, len(c0s) // 2)])
+            return [c0 for c0 in c0s if c0 in oldest]
+        return []
+
+    def get_random_c0s(self, gsmws_db, c0s):
+        logging.info("In get random c0s")
+        chosen_c0s = self.select_c0_candidates(gsmws_db, c0s)
+        logging.info("Channels %s, chose %s" % (c0s, chosen_c0s))
         return chosen_c0s
-      
 
-    def put_c0s_into_file(self, gsmws_db, c0s):
+    def put_c0s_into_file(self, gsmws_db, c0s, transaction=None):
+        """ Write the C0s we want to scan into C0_FILE, one per line. If a
+        transaction is given, the write is added to it; otherwise we apply it
+        right away. Either way the file is only rewritten if it changed.
+
+        Returns False (and leaves the file alone) if there's nothing to write.
+        """
         logging.info("In Put c0s into file")
         c0s_for_file =self.get_random_c0s(gsmws_db, c0s)
         if len(c0s_for_file) == 0:
-            logging.info("C0s for file is empty")
-            self.put_c0s_into_file(gsmws_db, c0s)
+            logging.warning("No C0s to put in file, leaving it alone")
+            return False
+
+        content = "".join(["%d\n" % c0 for c0 in c0s_for_file])
+        if transaction is None:
+            with self.transaction() as t:
+                t.write_file(C0_FILE, content)
         else:
-            logging.info("Putting C0s in file")
-            with open('/var/run/c0file.txt', 'w+') as c0file:
-                c0file.truncate()
-                for c0 in c0s_for_file:
-                    c0file.write("%d\n" % c0)
+            transaction.write_file(C0_FILE, content)
+        return True
 
 
-    def set_neighbors(self, arfcns, gsmws_db, real=[]):
+    @profiling.timed("bts.set_neighbors")
+    def set_neighbors(self, arfcns, gsmws_db, real=[], verify=False):
         """
         The new OpenBTS handover feature makes setting the neighbor list a bit
         more complicated. You're supposed to just set the IP addresses of the
@@ -210,32 +435,22 @@ class BTS(object):
         Args:
             arfcns: List of ARFCNs to scan
             real:   List of real BTS neighbor IP addresses
+            verify: Re-read our NeighborTable rows first, in case OpenBTS
+                    changed them behind our back
 
         Returns:
             True if we successfully set up the new neighbors, false otherwise
         """
           
-        # set GSM.Neighbors to empty string 
-        try:
-            #logging.info("In setting GSM.Neighbors to empty string")
-            #logging.info("Gsmws db conneciton % s" % gsmws_db)
-            r = self.node_manager.update_config("GSM.Neighbors", "")
-           # logging.debug("Updating neighbors (%s) '%s': '%s'" % (arfcns, neighbor_string, r.data))
-            #logging.info("Updating neighbors with empty string %s'" % r.data)
-        except openbts.exceptions.InvalidResponseError:
-            logging.debug("neighbors unchanged")
-            logging.info("neighbors unchanged")
+        t = self.transaction()
 
         # put random c0s into file
-        #logging.info("About to enter put c0s into file")
-        self.put_c0s_into_file(gsmws_db, arfcns)
-
-        # Need to generate a mapping of ARFCNs : IPs
-        #logging.info("About to put fake IPs in GSM.Neighbors")
-        fake_neighbors = {}
-        # set 5 IPs  len(arfcns)
-        for i in range(0, 7):
-            chan = arfcns[i]
+        self.put_c0s_into_file(gsmws_db, arfcns, t)
+
+        # Need to generate a mapping of ARFCNs : IPs. Keep the IPs in order so
+        # the same number of ARFCNs always gives the same GSM.Neighbors string.
+        fake_neighbors = collections.OrderedDict()
+        for i, chan in enumerate(arfcns):
             fake_neighbors[chan] = "127.0.0.%d:16001" % (i + 10,)
 
         real_ip_str = " ".join([str(bts_ip) for bts_ip in real])
@@ -246,20 +461,22 @@ class BTS(object):
         # set IPs in openbts
         # leading space will choke OpenBTS
         neighbor_string = ("%s %s" % (real_ip_str, fake_ip_str)).strip()
+        t.set_neighbors(neighbor_string)
+
+        # We only send what changed since last time, so if we're scanning the
+        # same number of ARFCNs, OpenBTS doesn't hear from us at all.
         try:
-            r = self.node_manager.update_config("GSM.Neighbors", neighbor_string)
-            logging.debug("Updating neighbors (%s) '%s': '%s'" % (arfcns, neighbor_string, r.data))
-            logging.info("Updating neighbors (%s) '%s': '%s'" % (arfcns, neighbor_string, r.data))
-        except openbts.exceptions.InvalidResponseError:
-            # OpenBTS won't accept the same list of neighbor IPs twice, so this
-            # will come up every time we set the same number of ARFCNs to scan.
-            # Totally normal.
-            logging.debug("neighbors unchanged")
-            logging.info("neighbors unchanged")
+            changed = t.commit()
+        except openbts.exceptions.InvalidRequestError as e:
+            logging.error("Unable to update neighbors (%s): %s" % (arfcns, e))
+            return False
+        logging.info("Updating neighbors (%s) '%s': changed %s"
+                     % (arfcns, neighbor_string, changed))
 
 
         # Update the neighbor table for each fake neighbor. Real neighbors
-        # should be updated automatically on their own.
+        # should be updated automatically on their own. The writer only
+        # touches rows that changed since the last time we were here.
         #
         # IP: one of our fake IPs
         # Updated: Time when we updated the neighbor
@@ -267,26 +484,12 @@ class BTS(object):
         #          attempting another handover with this neighbor after failure.
         # C0: The ARFCN we want to scan
         # BSIC: The BSIC. Can be set to whatever?
-        updated = int(datetime.datetime.now().strftime("%s"))
-        holdoff = 3600*24*7 # 7 days
         bsic = 1 # TODO does this matter?
-
-        """
-       #  try:
-           #  delete_query_str = "DELETE FROM NEIGHBOR_TABLE WHERE 1;"
-           #  self.neighbor_table.execute(delete_query_str)
-           #  for arfcn, ip in fake_neighbors.iteritems():
-               # query_str = "UPDATE NEIGHBOR_TABLE SET C0 = ?, UPDATED = ?, HOLDOFF = ?, BSIC = ? WHERE IPADDRESS = ?;"
-               # delete_query_str = "DELETE FROM NEIGHBOR_TABLE WHERE 1;"
-               # self.neighbor_table.execute(delete_query_str)
-               #  insert_query_str = "INSERT INTO NEIGHBOR_TABLE VALUES(?,?,?,?,?);"
-               # self.neighbor_table.execute(query_str, (arfcn, updated, holdoff, bsic, ip))
-               #  self.neighbor_table.execute(insert_query_str, (ip, updated, holdoff, arfcn, bsic))
-            # self.neighbor_table.commit()
-            # logging.info("Updated NeighborTable.")
-           # return True
-       # except sqlite3.OperationalError as operationalError:
-           #  logging.info("SQlite Operational Error is : '%s'" % operationalError)
-           #  logging.info("Could not update NeighborTable.")
-           #  return False
-        """
+        rows = dict((ip, (arfcn, bsic)) for arfcn, ip in fake_neighbors.items())
+        try:
+            self.neighbor_table.sync(rows, verify=verify)
+        except sqlite3.OperationalError as operationalError:
+            logging.info("SQlite Operational Error is : '%s'" % operationalError)
+            logging.info("Could not update NeighborTable.")
+            return False
+        return True
@@ -0,0 +1,302 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import re
+import glob
+import time
+import Queue
+import logging
+import threading
+import subprocess
+import multiprocessing
+
+from profiling import timers
+
+"""
+With more than one BTS on a host, we used to run one tshark per BTS, each
+capturing all the GSMTAP traffic and throwing away what wasn't sent to its
+BTS's address. CaptureDemux runs off a single capture instead: it reads
+tshark -V -n output, works out where each packet was going from its IP and UDP
+headers, and hands the whole packet to that BTS's decoder. Capture and
+dissection happen once, however many BTS units there are.
+
+Each decoder reads from a LineQueue, which looks just like the tshark stdout
+it used to read from.
+"""
+
+"""
+RingCapture is the other half: rather than live tshark -V (one core, and when
+it falls behind the kernel drops packets), dumpcap writes a ring of short pcap
+files and a pool of tshark -V -r workers dissects finished files in parallel.
+Output comes back out in file order -- which is capture order -- as one
+stream of lines, so it can feed a GSMDecoder or a CaptureDemux just like
+tshark's stdout did. Files are deleted once their lines have been handed over.
+dumpcap never waits on us; if we fall more than max_backlog files behind we
+delete the oldest ones unread (and count them) rather than fill the disk.
+"""
+
+regex = {'ip_dst': re.compile("Dst: ([0-9A-Fa-f:.]+)"),
+         'udp_dst_port': re.compile("Dst Port: (\d+)")}
+
+def parse_bts_map(spec):
+    """
+    Parse an address-to-BTS map like "127.0.0.1=0,127.0.0.2:4729=1" into
+    {(address, port): bts id}. A port of None matches any port.
+    """
+    routes = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        dest, bts_id = item.rsplit("=", 1)
+        if dest.count(":") == 1: # address:port (not IPv6)
+            addr, port = dest.split(":")
+            routes[(addr, int(port))] = int(bts_id)
+        else:
+            routes[(dest, None)] = int(bts_id)
+    return routes
+
+class LineQueue(object):
+    """
+    A stream of lines fed by another thread, one packet at a time. If the
+    reader falls more than maxsize packets behind we drop packets rather than
+    hold up the capture (and every other BTS's decoder with it).
+    """
+    def __init__(self, maxsize=10000):
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.packets = 0
+
+    def put(self, lines):
+        try:
+            self.queue.put_nowait(lines)
+            self.packets += 1
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ End the stream. Never blocks: if the reader has stalled with the
+        queue full, we drop its oldest packets to make room for the end. """
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty:
+                    pass
+
+    def __iter__(self):
+        while True:
+            lines = self.queue.get()
+            if lines is None:
+                return
+            for line in lines:
+                yield line
+
+class CaptureDemux(threading.Thread):
+    """
+    Routes packets from one tshark -V -n stream to per-BTS LineQueues by
+    destination address and port. Packets for destinations not in routes are
+    dropped.
+    """
+    def __init__(self, stream, routes, maxsize=10000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.routes = dict(routes)
+        self.outputs = {}
+        for bts_id in set(self.routes.values()):
+            self.outputs[bts_id] = LineQueue(maxsize)
+        self.unrouted = 0
+
+    def stream_for(self, bts_id):
+        """ The stream to hand to BTS bts_id's GSMDecoder. """
+        return self.outputs[bts_id]
+
+    def route(self, addr, port):
+        if (addr, port) in self.routes:
+            return self.routes[(addr, port)]
+        return self.routes.get((addr, None))
+
+    def _dispatch(self, packet, addr, port):
+        if not packet:
+            return
+        bts_id = self.route(addr, port)
+        if bts_id is None:
+            self.unrouted += 1
+            return
+        self.outputs[bts_id].put(packet)
+
+    def run(self):
+        # tshark -V puts each packet's "Frame N: ..." summary on an unindented
+        # line, followed by one unindented line per protocol layer.
+        packet = []
+        addr = port = None
+        for line in self.stream:
+            if line.startswith("Frame "):
+                self._dispatch(packet, addr, port)
+                packet = [line]
+                addr = port = None
+                continue
+            packet.append(line)
+            if addr is None and line.startswith("Internet Protocol"):
+                m = regex['ip_dst'].search(line)
+                if m:
+                    addr = m.group(1)
+            elif port is None and line.startswith("User Datagram Protocol"):
+                m = regex['udp_dst_port'].search(line)
+                if m:
+                    port = int(m.group(1))
+        self._dispatch(packet, addr, port)
+        logging.warning("Capture ended (unrouted packets: %d)" % self.unrouted)
+        for output in self.outputs.values():
+            output.close()
+
+    def stats(self):
+        return {"unrouted": self.unrouted,
+                "bts": dict((bts_id, {"packets": q.packets, "dropped": q.dropped})
+                            for bts_id, q in self.outputs.items())}
+
+def ring_sequence(path):
+    """ dumpcap names ring files <prefix>_<sequence>_<timestamp>.<ext> """
+    return int(os.path.basename(path).split("_")[-2])
+
+def dissect_file(task):
+    """ Pool worker: tshark -V one ring file. """
+    path, tshark, display_filter = task
+    start = time.time()
+    cmd = [tshark, "-V", "-n", "-r", path]
+    if display_filter:
+        cmd += ["-Y", display_filter]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    lines = proc.stdout.readlines()
+    proc.stdout.close()
+    proc.wait()
+    return path, lines, time.time() - start
+
+class RingCapture(object):
+    """
+    An iterable of tshark -V lines from a dumpcap ring in ringdir, dissected
+    by processes workers (default: one per core).
+    """
+    def __init__(self, ringdir, interface="any", capture_filter="udp dst port 4729",
+                 file_seconds=2, processes=None, max_backlog=300, display_filter=None,
+                 dumpcap="dumpcap", tshark="tshark", poll=0.2):
+        self.ringdir = ringdir
+        self.interface = interface
+        self.capture_filter = capture_filter
+        self.file_seconds = file_seconds
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_backlog = max_backlog
+        self.display_filter = display_filter
+        self.dumpcap = dumpcap
+        self.tshark = tshark
+        self.poll = poll
+        self.proc = None
+        self.stopped = threading.Event()
+        # don't hand the pool more than this many files at once, so a backlog
+        # stays on disk where we can see (and trim) it
+        self.in_flight = threading.Semaphore(self.processes * 2)
+        self.last_dispatched = -1
+        self.stats_lock = threading.Lock()
+        self.files = 0
+        self.dropped = 0
+        self.backlog = 0
+        self.lag = 0.0 # capture to hand-over, most recent file (seconds)
+        self.max_lag = 0.0
+        self.dissect_time = 0.0
+
+    def start(self):
+        if not os.path.isdir(self.ringdir):
+            os.makedirs(self.ringdir)
+        cmd = [self.dumpcap, "-q", "-i", self.interface, "-b", "duration:%d" % self.file_seconds,
+               "-w", os.path.join(self.ringdir, "gsmws.pcap")]
+        if self.capture_filter:
+            cmd += ["-f", self.capture_filter]
+        logging.info("Starting capture: %s" % " ".join(cmd))
+        self.proc = subprocess.Popen(cmd)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def capturing(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def completed(self):
+        """ Ring files dumpcap has finished with that we haven't dispatched, oldest first. """
+        capturing = self.capturing() # before listing, so we don't miss the last file
+        files = sorted(glob.glob(os.path.join(self.ringdir, "gsmws_*")), key=ring_sequence)
+        if capturing and files:
+            files = files[:-1] # still being written
+        return [f for f in files if ring_sequence(f) > self.last_dispatched]
+
+    def _tasks(self):
+        # runs in the pool's task handler thread
+        while not self.stopped.is_set():
+            files = self.completed()
+            if len(files) > self.max_backlog:
+                for f in files[:-self.max_backlog]:
+                    os.unlink(f)
+                    self.last_dispatched = ring_sequence(f)
+                with self.stats_lock:
+                    self.dropped += len(files) - self.max_backlog
+                logging.warning("Dissection is %d files behind, dropped %d"
+                                % (len(files), len(files) - self.max_backlog))
+                files = files[-self.max_backlog:]
+            self.backlog = len(files)
+            if not files:
+                if not self.capturing():
+                    return
+                self.stopped.wait(self.poll)
+                continue
+            for f in files:
+                while not self.in_flight.acquire(False):
+                    if self.stopped.wait(self.poll):
+                        return
+                self.last_dispatched = ring_sequence(f)
+                yield (f, self.tshark, self.display_filter)
+
+    def __iter__(self):
+        if self.proc is None:
+            self.start()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            # imap hands results back in the order we gave it files
+            for path, lines, elapsed in pool.imap(dissect_file, self._tasks()):
+                try:
+                    captured = os.path.getmtime(path)
+                except OSError:
+                    captured = None
+                for line in lines:
+                    yield line
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self.in_flight.release()
+                timers.record("capture.dissect", elapsed)
+                with self.stats_lock:
+                    self.files += 1
+                    self.dissect_time += elapsed
+                    if captured is not None:
+                        self.lag = time.time() - captured
+                        self.max_lag = max(self.max_lag, self.lag)
+        finally:
+            self.stop()
+            pool.terminate()
+            pool.join()
+
+    def stats(self):
+        with self.stats_lock:
+            return {"files": self.files, "dropped": self.dropped,
+                    "backlog": self.backlog, "lag": self.lag, "max_lag": self.max_lag,
+                    "dissect_time": self.dissect_time}
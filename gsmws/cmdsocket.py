@@ -0,0 +1,160 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import socket
+import logging
+import threading
+
+"""
+OpenBTS listens for CLI commands on a UNIX datagram socket (/var/run/command by
+default). OpenBTSDo and OpenBTSCLI just bind their own socket, send the command
+string, and wait for a single datagram back with the output. We do the same
+thing here, but keep our socket around so we don't pay for a shell, sudo and
+OpenBTSDo every time we want to change txatten.
+
+There's no request ID in the protocol, so we only ever have one command in
+flight per socket. If a response doesn't show up in time we throw the socket
+away and bind a new one, so a late response can never be mistaken for the
+answer to the next command.
+"""
+
+# "Known" error messages from OpenBTS (CLI/CLI.cpp). OpenBTS doesn't tell us if
+# a command failed, so we have to guess based on the output.
+failure_messages = ["wrong number of arguments",
+                    "bad argument(s)",
+                    "command not found",
+                    "too many arguments for parser",
+                    "command failed"]
+
+BUFSIZE = 65536
+
+class CommandError(ValueError):
+    """ OpenBTS says the command failed (or at least we think it did). """
+    pass
+
+class CommandTimeout(IOError):
+    """ OpenBTS didn't answer us in time. """
+    pass
+
+def check_response(response):
+    """
+    Raise a CommandError if the response contains one of the known OpenBTS
+    failure messages, otherwise return it unchanged.
+    """
+    for msg in failure_messages:
+        if msg in response:
+            raise CommandError("%s: %s" % (msg, response))
+    return response
+
+class CommandSocket(object):
+    """
+    A persistent client for the OpenBTS command socket.
+    """
+    def __init__(self, path='/var/run/command', timeout=5.0, retries=1,
+                 local_dir='/tmp'):
+        self.path = path
+        self.timeout = timeout
+        self.retries = retries
+        self.local_dir = local_dir
+
+        self.lock = threading.Lock()
+        self.sock = None
+        self.local_path = None
+        self.connects = 0
+
+    def _local_name(self):
+        # OpenBTSDo uses /tmp/OpenBTS.do.<pid>; keep ours distinguishable
+        return os.path.join(self.local_dir, "gsmws.cmd.%d.%d.%d"
+                            % (os.getpid(), id(self), self.connects))
+
+    def connect(self):
+        """ Bind a fresh local socket and point it at OpenBTS. """
+        self.close()
+        self.connects += 1
+        self.local_path = self._local_name()
+        if os.path.exists(self.local_path):
+            os.unlink(self.local_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.local_path)
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            self._unlink()
+            raise
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        logging.debug("Connected to OpenBTS command socket %s" % self.path)
+
+    def _unlink(self):
+        if self.local_path is not None:
+            try:
+                os.unlink(self.local_path)
+            except OSError:
+                pass
+            self.local_path = None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self._unlink()
+
+    def _drain(self):
+        """ Throw away anything that's sitting in our queue already. """
+        self.sock.setblocking(0)
+        try:
+            while True:
+                stale = self.sock.recv(BUFSIZE)
+                logging.debug("Dropping stale OpenBTS response: %r" % stale)
+        except socket.error:
+            pass
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def _send(self, command_str):
+        if self.sock is None:
+            self.connect()
+        self._drain()
+        self.sock.send(command_str.encode('utf-8') + b'\0')
+        data = self.sock.recv(BUFSIZE)
+        return data.decode('utf-8', 'replace').rstrip('\0').strip()
+
+    def send(self, command_str):
+        """
+        Send a single command and return OpenBTS's (stripped) response. We
+        reconnect and retry on socket errors, up to self.retries times.
+
+        Raises CommandTimeout if OpenBTS never answers, or socket.error if we
+        can't talk to it at all.
+        """
+        with self.lock:
+            attempt = 0
+            while True:
+                try:
+                    return self._send(command_str)
+                except socket.timeout:
+                    # drop the socket so the late reply goes nowhere
+                    self.close()
+                    if attempt >= self.retries:
+                        raise CommandTimeout("no response to '%s' from %s"
+                                             % (command_str, self.path))
+                except socket.error as e:
+                    self.close()
+                    if attempt >= self.retries:
+                        raise
+                    logging.warning("OpenBTS command socket error (%s), "
+                                    "reconnecting" % e)
+                attempt += 1
+
+    def command(self, command_str):
+        """
+        Like send(), but raises CommandError if the output looks like a
+        failure.
+        """
+        return check_response(self.send(command_str))
@@ -0,0 +1,105 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import logging
+import threading
+import collections
+
+"""
+Co-channel detection from BSICs. Phones report a BSIC for every neighbor they
+can decode, and for an ARFCN where we know who should be there -- our own C0,
+or one of our other BTS units -- a different BSIC means another tower is on
+that channel. That shows up within a few reports, rather than after the RSSI
+averages over the last 100 have drifted.
+
+Phones only report ARFCNs that are in the neighbor list they were given, so we
+only see our own C0 this way when it's in there too.
+
+To avoid jumping at one bad decode, a foreign BSIC has to be seen confidence
+times within window seconds before we call it. After that we stay quiet about
+the same (ARFCN, BSIC) for holdoff seconds.
+"""
+
+class CoChannelDetector(object):
+    def __init__(self, confidence=3, window=30, holdoff=300):
+        self.confidence = confidence
+        self.window = window
+        self.holdoff = holdoff
+        self.lock = threading.Lock()
+        self.expected = {} # arfcn -> bsic that should be there
+        self.sightings = {} # (arfcn, foreign bsic) -> deque of times seen
+        self.fired = {} # (arfcn, foreign bsic) -> when we last called it
+        self.listeners = [] # called as fn(arfcn, bsic, expected bsic)
+        self.events = 0
+        self.last_prune = 0
+
+    def add_listener(self, fn):
+        self.listeners.append(fn)
+
+    def expect(self, arfcn, bsic):
+        """ bsic should be on arfcn (our C0, or one of our neighbors). """
+        with self.lock:
+            if self.expected.get(arfcn) == bsic:
+                return
+            self.expected[arfcn] = bsic
+            self._clear(arfcn)
+
+    def forget(self, arfcn):
+        with self.lock:
+            self.expected.pop(arfcn, None)
+            self._clear(arfcn)
+
+    def _clear(self, arfcn):
+        for key in [k for k in self.sightings if k[0] == arfcn]:
+            del self.sightings[key]
+        for key in [k for k in self.fired if k[0] == arfcn]:
+            del self.fired[key]
+
+    def _prune(self, now):
+        # forget one-off sightings that have aged out of the window
+        for key, seen in list(self.sightings.items()):
+            if not seen or now - seen[-1] > self.window:
+                del self.sightings[key]
+        self.last_prune = now
+
+    def observe(self, arfcn, bsic, now=None):
+        """ A phone heard bsic on arfcn. Returns True if that set off an event. """
+        expected = self.expected.get(arfcn)
+        if expected is None or bsic is None or bsic == expected:
+            return False
+        if now is None:
+            now = time.time()
+        key = (arfcn, bsic)
+        with self.lock:
+            if now - self.last_prune > self.window:
+                self._prune(now)
+            seen = self.sightings.setdefault(key, collections.deque())
+            seen.append(now)
+            while seen and now - seen[0] > self.window:
+                seen.popleft()
+            if len(seen) < self.confidence:
+                return False
+            if key in self.fired and now - self.fired[key] < self.holdoff:
+                return False
+            self.fired[key] = now
+            self.events += 1
+        logging.warning("Co-channel: BSIC %d on ARFCN %d (expected %d), seen %d times in %ds"
+                        % (bsic, arfcn, expected, len(seen), self.window))
+        for fn in self.listeners:
+            fn(arfcn, bsic, expected)
+        return True
+
+    def observe_report(self, report, serving_arfcn, now=None):
+        """ Check every BSIC in a gsm.MeasurementReport. """
+        for bsic in report.own_bsics:
+            self.observe(serving_arfcn, bsic, now)
+        for arfcn, bsic in report.current_bsics.items():
+            if bsic is not None:
+                self.observe(arfcn, bsic, now)
+
+    def stats(self):
+        with self.lock:
+            return {"expected": dict((str(a), b) for a, b in self.expected.items()),
+                    "events": self.events}
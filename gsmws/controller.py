@@ -9,10 +9,19 @@ import random
 import sqlite3
 import logging
 import threading
+import xmlrpclib
 
+import aggregator
 import decoder
 import gsm
 import bts
+import dwell
+import planner
+import profiling
+import reconfig
+import scanplan
+import scheduler
+import filters
 
 
 """
@@ -23,12 +32,16 @@ The controller has three tasks:
 """
 class Controller(object):
     def __init__(self, db_loc, openbts_proc, trans_proc, nct, sleep, gsmwsdb,
-                 loglvl=logging.DEBUG, bts_class=bts.BTS):
+                 loglvl=logging.DEBUG, bts_class=bts.BTS, publisher=None,
+                 aggregator_url=None, min_cycle=60):
         self.OPENBTS_PROCESS_NAME=openbts_proc
         self.TRANSCEIVER_PROCESS_NAME=trans_proc
 
-        # seconds to wait before switching up the neighbor list
+        # longest we'll wait before switching up the neighbor list (seconds).
+        # We move on as soon as the scan has settled (see dwell.py), but not
+        # before MIN_CYCLE_TIME.
         self.NEIGHBOR_CYCLE_TIME = nct
+        self.MIN_CYCLE_TIME = min(min_cycle, nct)
 
         # seconds between rssi checks
         self.SLEEP_TIME = sleep
@@ -42,17 +55,78 @@ class Controller(object):
         self.bts = None
         self.bts_class = bts_class
 
+        # decides if and when we change C0 (each change is a restart)
+        self.planner = planner.ChangePlanner()
+
+        self.CHANNELS = range(1, 121) # the band we scan
+        self.c0s_to_scan = [] # scanned so far in this pass over the band
+        self.stopped = threading.Event() # set by stop() to end main()
+        self.dwell = None
+        self.scheduler = None
+
+        # if set, the decoder pushes reports and summaries out through this
+        self.publisher = publisher
+
+        # if set, we also check the regional map before picking a channel
+        self.regional = None
+        if aggregator_url is not None:
+            self.regional = xmlrpclib.ServerProxy(aggregator_url,
+                                transport=aggregator.TimeoutTransport(2.0))
+
         self.loglvl = loglvl
         logging.basicConfig(format=('%(asctime)s %(module)s %(funcName)s '
                                     '%(lineno)d %(levelname)s %(message)s'),
                             filename='/var/log/gsmws.log',level=loglvl)
         logging.warning("New controller started.")
 
+        # SIGHUP and the control API hand new settings to this, and we pick
+        # them up at the start of the next tick (see reconfig.py). We need 7
+        # channels to pick a neighbor set from.
+        self.reconfig = reconfig.Reconfigurator(self.configuration(), min_channels=7)
+
+    def configuration(self):
+        """ The settings reconfigure() takes, as they are now. """
+        return {"cycle": self.NEIGHBOR_CYCLE_TIME,
+                "min_cycle": self.MIN_CYCLE_TIME,
+                "sleep": self.SLEEP_TIME,
+                "channels": list(self.CHANNELS),
+                "loglevel": logging.getLevelName(self.loglvl).lower()}
+
+    def reconfigure(self, settings):
+        """ Switch to validated settings (see reconfig.py). Main loop only,
+        between ticks. The decoder and everything it knows carry on. """
+        self.NEIGHBOR_CYCLE_TIME = settings["cycle"]
+        self.MIN_CYCLE_TIME = settings["min_cycle"]
+        self.SLEEP_TIME = settings["sleep"]
+        self.CHANNELS = list(settings["channels"])
+        self.loglvl = reconfig.LOG_LEVELS[settings["loglevel"]]
+        logging.getLogger().setLevel(self.loglvl)
+        if self.dwell is not None:
+            self.dwell.min_cycle = self.MIN_CYCLE_TIME
+            self.dwell.max_cycle = self.NEIGHBOR_CYCLE_TIME
+        if self.bts is not None and self.bts.decoder is not None:
+            self.bts.decoder.NEIGHBOR_CYCLE_TIME = self.NEIGHBOR_CYCLE_TIME
+        if self.scheduler is not None:
+            for task in self.scheduler.tasks:
+                task.period = self.SLEEP_TIME
+            self.scheduler.tick_budget = self.SLEEP_TIME / 2.0
+        logging.warning("Reconfigured: %s" % settings)
+
+    def apply_configuration(self):
+        """ Start of a tick: take any new settings, all at once. """
+        settings = self.reconfig.take()
+        if settings is None:
+            return
+        self.reconfigure(settings)
+        self.reconfig.applied_ok(settings)
+
     def initdb(self):
         with self.gsmwsdb_lock:
             self.gsmwsdb.execute("CREATE TABLE IF NOT EXISTS AVAIL_ARFCN "
                                  "(TIMESTAMP TEXT NOT NULL, ARFCN INTEGER, "
                                  "RSSI REAL);")
+            self.gsmwsdb.execute("CREATE INDEX IF NOT EXISTS AVAIL_ARFCN_ARFCN "
+                                 "ON AVAIL_ARFCN (ARFCN);")
             self.gsmwsdb.execute("CREATE TABLE IF NOT EXISTS MAX_STRENGTHS "
                                  "(TIMESTAMP TEXT NOT NULL, ARFCN INTEGER, "
                                  "RSSI REAL);")
@@ -60,6 +134,7 @@ class Controller(object):
                                  "(TIMESTAMP TEXT NOT NULL, ARFCN INTEGER, "
                                  "RSSI REAL, COUNT INTEGER);")
 
+    @profiling.timed("controller.update_rssi_db")
     def update_rssi_db(self, rssis):
         # rssis: A dict of ARFCN->RSSI that's up to date as of now (it already
         # captures our historical knowledge)
@@ -102,16 +177,45 @@ class Controller(object):
                 candidates.append(arfcn)
         return candidates
 
-    def pick_new_safe_arfcn(self):
-        """ Returns a random ARFCN that we have verified to be safe (i.e., <0 RSSI) """
-        return random.choice(self.safe_arfcns())
+    def regional_safe_arfcns(self):
+        """ ARFCNs the aggregator says are safe across the region, or None if
+        we don't have an aggregator (or can't reach it). """
+        if getattr(self, "regional", None) is None:
+            return None
+        try:
+            return self.regional.safe_arfcns()
+        except Exception as e:
+            logging.warning("Can't reach aggregator: %s" % e)
+            return None
+
+    def observations(self):
+        """ {arfcn: (rssi, time observed)} for everything in AVAIL_ARFCN. """
+        with self.gsmwsdb_lock:
+            res = self.gsmwsdb.execute("SELECT ARFCN, RSSI, TIMESTAMP FROM AVAIL_ARFCN").fetchall()
+        return dict((arfcn, (rssi, time.mktime(bts.parse_timestamp(ts).timetuple())))
+                    for arfcn, rssi, ts in res)
+
+    def pick_new_safe_arfcn(self, current=None):
+        """ Returns the ARFCN we have verified to be safe (i.e., <0 RSSI) that
+        the planner likes best. If the regional map is available, prefer
+        ARFCNs that are safe there too. Raises IndexError if there isn't one. """
+        arfcn = self.planner.choose(self.observations(), current,
+                                    regional=self.regional_safe_arfcns())
+        if arfcn is None:
+            raise IndexError("no safe ARFCNs")
+        return arfcn
+
+    def cochannel_event(self, arfcn, bsic, expected):
+        """ Decoder thread: somebody else is on arfcn. If that's our C0, the
+        next tick moves us off it (see planner.py). """
+        self.planner.threaten(0, arfcn, "foreign BSIC %d, expected %d" % (bsic, expected))
 
     def pick_new_neighbors(self):
         """ Pick a set of ARFCNs we haven't scanned before """
         with self.gsmwsdb_lock:
             available_arfcns = (self.gsmwsdb.execute("SELECT ARFCN FROM AVAIL_ARFCN").fetchall())
             existing = [arfcn for res in available_arfcns for arfcn in res]
-        return random.sample([_ for _ in range(1,124) if _ not in existing], 15)
+        return random.sample([_ for _ in self.CHANNELS if _ not in existing], 15)
 
     def main(self, stream=None, cmd=None):
         self.initdb() # set up the gsmws db
@@ -120,65 +224,119 @@ class Controller(object):
 
         if stream==None:
             if cmd==None:
-                cmd = "tshark -V -n -i any udp dst port 4729"
+                # only capture what the decoder reads (see filters.py)
+                cmd = filters.command(decoder.GSMDecoder.HANDLERS)
             stream = gsm.command_stream(cmd)
 
         gsmd = decoder.GSMDecoder(stream, self.gsmwsdb_lock,
-                                  self.gsmwsdb_location, self.NEIGHBOR_CYCLE_TIME, loglvl=self.loglvl)
+                                  self.gsmwsdb_location, self.NEIGHBOR_CYCLE_TIME, loglvl=self.loglvl,
+                                  publisher=self.publisher)
         self.bts = self.bts_class();
         
         self.bts.init_decoder(gsmd)
-        c0s_to_scan = [1, 2, 3, 4, 5, 6, 7]
-        self.bts.set_neighbors(c0s_to_scan, self.gsmwsdb)
-        last_cycle_time = datetime.datetime.now()
-        ignored_since = datetime.datetime.now()
-        while True:
-            try:
-                now = datetime.datetime.now()
-
-                if self.bts.decoder.ignore_reports and (now - ignored_since).seconds > 120:
-                    self.bts.decoder.ignore_reports = False
-
-                td = (now - last_cycle_time)
-                if td.seconds > self.NEIGHBOR_CYCLE_TIME:
-                    logging.info('Neigbor Cycle Time')
-                    try:
-                        new_arfcn = self.pick_new_safe_arfcn()
-                        logging.info("New ARFCN picked is %s" % new_arfcn)
-                        self.bts.change_arfcn(new_arfcn)
-                    except IndexError:
-                        logging.error("Unable to pick new safe ARFCN!")
-                        pass # just don't pick for now
-                    #logging.info("Self Gsmws db connection %s" % self.gsmwsdb)
-                    #new_c0s_to_scan = [43, 44, 45, 81, 82, 83, 84]
-                    
-                    new_c0s_to_scan = random.sample([_ for _ in range(1, 121) if _ not in c0s_to_scan], 7)
-                    logging.info("New c0s to scan %s" % new_c0s_to_scan)
-                    c0s_to_scan.extend(new_c0s_to_scan)                
-                    logging.info('C0s to scan %s' % c0s_to_scan)           
-                    self.bts.set_neighbors(new_c0s_to_scan, self.gsmwsdb)
-                    self.bts.decoder.ignore_reports = True
-                    ignored_since = now
-                    last_cycle_time = now
-
-                logging.info("Current ARFCN: %s" % self.bts.current_arfcn())
-
-                rssis = self.bts.decoder.rssi()
-
-                # TODO this might actually be the right behavior -- why does
-                # the fact we used an arfcn before change whether we need to
-                # get a consistent clear scan before using it again? As long as
-                # it becomes a candidate again later this is fine.
-                #
-                # ignore readings for our own C0 (else, we never consider our
-                # own used arfcn safe until we scan it 100 times again!)
-                #del(rssis[self.gsmd.current_arfcn])
-
-                self.update_rssi_db(rssis)
-                logging.info("Safe ARFCNs: %s" % str(self.safe_arfcns()))
-                time.sleep(self.SLEEP_TIME)
-            except KeyboardInterrupt:
-                break
+        gsmd.cochannel.add_listener(self.cochannel_event)
+        self.dwell = dwell.AdaptiveDwell(self.bts, min_cycle=self.MIN_CYCLE_TIME,
+                                         max_cycle=self.NEIGHBOR_CYCLE_TIME)
+        gsmd.add_neighbor_listener(self.dwell.neighbors_changed)
+
+        self.c0s_to_scan = [1, 2, 3, 4, 5, 6, 7]
+        self.bts.set_neighbors(self.c0s_to_scan, self.gsmwsdb)
+        self.dwell.begin(self.c0s_to_scan)
+        self.expected_c0 = None # the C0 the co-channel detector is watching
+        self.our_bsic = None # what it expects to see there
+        self.last_c0 = None
+
+        # everything below runs on its own deadline (see scheduler.py). If a
+        # tick runs long, the LOW ones wait rather than pushing back the rest.
+        self.scheduler = scheduler.TickScheduler(tick_budget=self.SLEEP_TIME / 2.0,
+                                                 stopped=self.stopped, name="controller")
+        self.scheduler.add("configure", self.apply_configuration, self.SLEEP_TIME,
+                           scheduler.HIGH)
+        self.scheduler.add("dwell", self.dwell.update, self.SLEEP_TIME, scheduler.HIGH,
+                           budget=1.0)
+        self.scheduler.add("check_c0", self.check_c0, self.SLEEP_TIME, scheduler.HIGH,
+                           budget=2.0)
+        self.scheduler.add("cycle_neighbors", self.cycle_neighbors, self.SLEEP_TIME,
+                           scheduler.NORMAL, budget=5.0)
+        self.scheduler.add("record_rssi", self.record_rssi, self.SLEEP_TIME,
+                           scheduler.LOW, budget=2.0)
+        self.scheduler.add("log_status", self.log_status, self.SLEEP_TIME,
+                           scheduler.LOW, budget=0.5)
+        self.scheduler.run()
+
+    def check_c0(self):
+        """ Only move off our C0 if something says it's in use (and the
+        planner's rate limits agree). """
+        if self.bts.restarting:
+            # NodeManager is down and the restart thread is probing it; don't
+            # queue up behind that. Read the BSIC again once OpenBTS is back.
+            self.our_bsic = None
+            return
+        gsmd = self.bts.decoder
+        current_arfcn = self.bts.current_arfcn()
+        self.last_c0 = current_arfcn
+        if self.expected_c0 != current_arfcn:
+            if self.expected_c0 is not None:
+                gsmd.cochannel.forget(self.expected_c0)
+            self.our_bsic = None
+        if self.our_bsic is None:
+            # two NodeManager calls, so only after a restart or C0 change
+            self.our_bsic = self.bts.bsic()
+        gsmd.cochannel.expect(current_arfcn, self.our_bsic)
+        self.expected_c0 = current_arfcn
+        if self.planner.threatened(0, current_arfcn):
+            new_arfcn = self.planner.plan(0, current_arfcn, self.observations(),
+                                          regional=self.regional_safe_arfcns())
+            if new_arfcn is not None:
+                logging.info("New ARFCN picked is %s" % new_arfcn)
+                # the restart is what actually moves the radio; only count
+                # the change if it got going
+                if self.bts.change_arfcn(new_arfcn, True):
+                    self.planner.changed(0, current_arfcn, new_arfcn)
+
+    def cycle_neighbors(self):
+        """ Move on to new neighbors once the dwell says we're done here. """
+        if not self.dwell.due() or self.bts.restarting:
+            # OpenBTS can't take new neighbors mid-restart anyway
+            return
+        logging.info('Neigbor Cycle Time: %s' % self.dwell.summary())
+        #logging.info("Self Gsmws db connection %s" % self.gsmwsdb)
+        #new_c0s_to_scan = [43, 44, 45, 81, 82, 83, 84]
+
+        unscanned = [_ for _ in self.CHANNELS if _ not in self.c0s_to_scan]
+        if len(unscanned) < 7:
+            # covered the whole band, start another pass
+            logging.info("Finished a pass over the band")
+            self.c0s_to_scan = []
+            unscanned = list(self.CHANNELS)
+        new_c0s_to_scan = random.sample(unscanned, 7)
+        logging.info("New c0s to scan %s" % new_c0s_to_scan)
+        self.c0s_to_scan.extend(new_c0s_to_scan)
+        logging.info('C0s to scan %s' % self.c0s_to_scan)
+        self.bts.set_neighbors(new_c0s_to_scan, self.gsmwsdb)
+        self.dwell.begin(new_c0s_to_scan)
+
+    def record_rssi(self):
+        rssis = self.bts.decoder.rssi()
+
+        # TODO this might actually be the right behavior -- why does
+        # the fact we used an arfcn before change whether we need to
+        # get a consistent clear scan before using it again? As long as
+        # it becomes a candidate again later this is fine.
+        #
+        # ignore readings for our own C0 (else, we never consider our
+        # own used arfcn safe until we scan it 100 times again!)
+        #del(rssis[self.gsmd.current_arfcn])
+
+        self.update_rssi_db(rssis)
+
+    def log_status(self):
+        logging.info("Current ARFCN: %s" % self.last_c0)
+        logging.info("Safe ARFCNs: %s" % str(self.safe_arfcns()))
+
+    def stop(self):
+        """ Make main() return after the current tick. """
+        self.stopped.set()
 
 
 """
@@ -188,14 +346,20 @@ class HandoverController(Controller):
     def __init__(self, bts1_conf, bts2_conf, nct, sleep, max_delta, gsmwsdb, loglvl=logging.DEBUG):
         """
         A BTS config dictionary has the following items:
-        - db_loc: The OpenBTS.db location for this BTS
-        - openbts_proc: The name of the OpenBTS process, so we can kill it if necessary
-        - trans_proc: The name of the transceiver process, so we can kill it if necessary
         - bts_class: The type of BTS this is (bts.BTS or bts.OldBTS, for example)
         - stream: The stream to read from (either sys.STDIN or a gsm.command_stream)
+        - cmd_socket: This BTS's OpenBTS command socket
+        - node_manager: This BTS's NodeManager address (tcp://host:port)
         - start_cmd: A shell command that can properly restart this BTS
+        - db_loc, openbts_proc, trans_proc: The OpenBTS.db location and the
+          OpenBTS and transceiver process names. Informational; bts.BTS gets
+          everything it needs through cmd_socket and node_manager.
+
+        cmd_socket, node_manager and start_cmd can be left out (or None) to
+        use the BTS class's defaults, but no two units may end up talking to
+        the same OpenBTS: see setup_bts.
         """
-        self.BTS_CONF = [bts1_conf]
+        self.BTS_CONF = [bts1_conf, bts2_conf]
 
         self.NEIGHBOR_CYCLE_TIME = nct # seconds to wait before switching up the neighbor list
         self.SLEEP_TIME = sleep # seconds between rssi checks
@@ -206,6 +370,16 @@ class HandoverController(Controller):
         self.gsmwsdb = sqlite3.connect(gsmwsdb)
 
         self.bts_units = []
+        self.stopped = threading.Event() # set by stop() to end main()
+        self.c0s = {} # unit id -> its C0, read once a tick (see refresh_c0s)
+        self.bsics = {} # unit id -> its BSIC, read after a restart or C0 change
+        self.expected_c0s = {} # unit id -> the C0 the co-channel checks watch for it
+        self.planner = planner.ChangePlanner()
+        self.CHANNELS = range(1, 124) # where we look for neighbors
+
+        # splits CHANNELS between the units so they don't scan the same ones.
+        # Anything older than this gets expired from AVAIL_ARFCN anyway.
+        self.scan_planner = scanplan.ScanPlanner(self.CHANNELS, stale_after=4*nct)
 
         self.loglvl = loglvl
         logging.basicConfig(
@@ -213,24 +387,69 @@ class HandoverController(Controller):
             filename='/var/log/gsmws.log',level=loglvl)
         logging.warning("New HandoverController started.")
 
+        self.reconfig = reconfig.Reconfigurator(self.configuration(), min_channels=5)
+
+    def configuration(self):
+        return {"cycle": self.NEIGHBOR_CYCLE_TIME,
+                "sleep": self.SLEEP_TIME,
+                "delta": self.MAX_DELTA,
+                "channels": list(self.CHANNELS),
+                "loglevel": logging.getLevelName(self.loglvl).lower()}
+
+    def reconfigure(self, settings):
+        self.NEIGHBOR_CYCLE_TIME = settings["cycle"]
+        self.SLEEP_TIME = settings["sleep"]
+        self.MAX_DELTA = settings["delta"]
+        self.CHANNELS = list(settings["channels"])
+        self.scan_planner.channels = list(self.CHANNELS)
+        self.scan_planner.stale_after = 4*self.NEIGHBOR_CYCLE_TIME
+        self.loglvl = reconfig.LOG_LEVELS[settings["loglevel"]]
+        logging.getLogger().setLevel(self.loglvl)
+        for bts in self.bts_units:
+            if bts.decoder is not None:
+                bts.decoder.NEIGHBOR_CYCLE_TIME = self.NEIGHBOR_CYCLE_TIME
+        logging.warning("Reconfigured: %s" % settings)
+
+    def unit_settings(self, conf):
+        """ The BTS constructor arguments a config dictionary sets. """
+        settings = {}
+        for key, arg in (("cmd_socket", "cmd_socket"),
+                         ("node_manager", "node_manager_address"),
+                         ("start_cmd", "restart_cmd")):
+            if conf.get(key) is not None:
+                settings[arg] = conf[key]
+        return settings
+
     def setup_bts(self):
+        # two units on one command socket or NodeManager are one OpenBTS, and
+        # everything keyed on unit (c0s, arfcn_to_bts, the demuxed streams)
+        # would quietly collapse into it
+        for key in ("cmd_socket", "node_manager"):
+            endpoints = [conf.get(key) for conf in self.BTS_CONF]
+            if len(set(endpoints)) < len(endpoints):
+                raise ValueError("BTS units share %s %s; give each its own"
+                                 % (key, endpoints))
+
         cycle_offset = self.NEIGHBOR_CYCLE_TIME / float(len(self.BTS_CONF))
         cycle_count = 0
 
         now = datetime.datetime.now()
         for conf in self.BTS_CONF:
             gsmd = decoder.GSMDecoder(conf['stream'], self.gsmwsdb_lock, self.gsmwsdb_location,
-                                      loglvl=self.loglvl, decoder_id=cycle_count)
+                                      self.NEIGHBOR_CYCLE_TIME, loglvl=self.loglvl,
+                                      decoder_id=cycle_count)
         #    bts = conf['bts_class'](conf['db_loc'], conf['openbts_proc'], conf['trans_proc'],self.loglvl, id_num=cycle_count,start_time=(now+datetime.timedelta(seconds=90*cycle_count)))
 
-            bts = conf['bts_class'](self.loglvl);
+            bts = conf['bts_class'](self.loglvl, **self.unit_settings(conf))
+            gsmd.cochannel.add_listener(self.cochannel_event)
 
-            if not bts.offset_correct:
+            if not bts.offset_correct():
                 #this is set in factory, probably something he uses. 
                 raise ValueError("Non-default TRX.RadioFrequencyOffset, verify radios are properly configured.")
 
-            #bts.init_decoder(gsmd)
+            bts.init_decoder(gsmd)
 
+            bts.id_num = cycle_count
             # set up cycle time/ignored since
             bts.ignored_since = now
             # keep them out of sync, but make sure they start
@@ -239,20 +458,40 @@ class HandoverController(Controller):
             self.bts_units.append(bts)
             cycle_count += 1
 
+    def refresh_c0s(self):
+        """ Start of a tick: ask each unit for its C0, once. The rest of the
+        tick (and cochannel_event) works from self.c0s. A restarting unit
+        keeps the C0 it's moving to. BSICs only change with a restart, so we
+        only read those again after one. """
+        for bts in self.bts_units:
+            if bts.restarting:
+                self.bsics.pop(bts.id_num, None)
+                continue
+            c0 = bts.current_arfcn()
+            if self.c0s.get(bts.id_num) != c0:
+                self.bsics.pop(bts.id_num, None)
+            self.c0s[bts.id_num] = c0
+            if bts.id_num not in self.bsics:
+                self.bsics[bts.id_num] = bts.bsic()
+
+    def cochannel_event(self, arfcn, bsic, expected):
+        """ Decoder thread: somebody else is on arfcn. Threaten whichever of
+        our units is on it; the interference check below moves it. """
+        for bts in self.bts_units:
+            if self.c0s.get(bts.id_num) == arfcn:
+                self.planner.threaten(bts.id_num, arfcn,
+                                      "foreign BSIC %d, expected %d" % (bsic, expected))
+
     def pick_new_neighbors(self, bts_id_num, testing=True):
-        other_arfcns = [b.current_arfcn for b in self.bts_units if b.id_num != bts_id_num] # FIXME
+        """ The other units' C0s, plus this unit's share of the band to scan
+        (see scanplan.py). """
+        other_arfcns = [self.c0s[b.id_num] for b in self.bts_units if b.id_num != bts_id_num]
         if testing:
-            random_arfcns = [x.current_arfcn+10 for x in self.bts_units if x.current_arfcn!=None]
+            random_arfcns = [c0 + 10 for c0 in self.c0s.values()]
         else:
-            with self.gsmwsdb_lock:
-                available_arfcns = self.gsmwsdb.execute("SELECT ARFCN FROM AVAIL_ARFCN").fetchall()
-                existing = [arfcn for res in available_arfcns for arfcn in res]
-            random_arfcns = random.sample([_ for _ in range(1,124) if
-                                          (_ not in existing and _ not in other_arfcns)],
-                                          5 - len(other_arfcns))
+            random_arfcns = self.scan_planner.assign(bts_id_num, reserved=self.c0s.values())
         logging.info("BTS %d: Current ARFCN=%s Other ARFCNs: %s Random ARFCNs: %s"
-                     % (bts_id_num, self.bts_units[bts_id_num].current_arfcn,
-                        other_arfcns, random_arfcns))
+                     % (bts_id_num, self.c0s[bts_id_num], other_arfcns, random_arfcns))
         return other_arfcns + random_arfcns
 
    
@@ -262,20 +501,46 @@ class HandoverController(Controller):
         self.initdb() # set up the gsmws db
         self.setup_bts() # set up the BTS units
 
-        restarted = False
+        # units that have restarted since we last checked their neighbors
+        restarted = set()
 
-        while True:
+        while not self.stopped.is_set():
             try:
+                self.apply_configuration()
+                self.refresh_c0s()
                 now = datetime.datetime.now()
 
-                # disable ignore reports if expired
+                # disable ignore reports if expired. Restarting units stay
+                # ignored until their RestartOrchestrator says they're back.
                 for bts in self.bts_units:
+                    if bts.restarting:
+                        continue
                     if bts.decoder.ignore_reports and (now - bts.ignored_since).seconds > 120:
                         bts.decoder.ignore_reports = False
 
+                # tell every decoder who belongs on each of our C0s, so a
+                # foreign BSIC on any of them shows up (see cochannel.py)
+                for unit in self.bts_units:
+                    if unit.restarting:
+                        continue
+                    c0 = self.c0s[unit.id_num]
+                    old = self.expected_c0s.get(unit.id_num)
+                    for bts in self.bts_units:
+                        if old is not None and old != c0:
+                            bts.decoder.cochannel.forget(old)
+                        bts.decoder.cochannel.expect(c0, self.bsics[unit.id_num])
+                    self.expected_c0s[unit.id_num] = c0
+
+                # who can still scan? Restarting and quiet units hand their
+                # share of the band back for the others to pick up.
+                for bts in self.bts_units:
+                    self.scan_planner.update(bts.id_num, bts.restarting,
+                                             bts.decoder.reports.report_seq)
+
                 for bts in self.bts_units:
                     logging.info("BTS %d. Reported ARFCN=%s Intended Neighbors=%s Reported Neighbors=%s"
-                                 % (bts.id_num, bts.current_arfcn, sorted(bts.neighbors), sorted(bts.last_arfcns)))
+                                 % (bts.id_num, self.c0s[bts.id_num], sorted(bts.neighbors),
+                                    sorted(bts.decoder.last_arfcns)))
 
                 for bts in self.bts_units:
                     """
@@ -301,27 +566,36 @@ class HandoverController(Controller):
                     constrain this just to keep everything on the same figure;
                     we could change frequencies arbitrarily.
                     """
-                    bts.next_atten_state() # start updating the power levels for the bts units
+                    if bts.restarting:
+                        # OpenBTS is still coming back up; leave it alone
+                        continue
+
+                    # the txatten warbling experiment's BTS classes step
+                    # their power levels here; bts.BTS doesn't warble
+                    if hasattr(bts, "next_atten_state"):
+                        bts.next_atten_state()
 
                     # this block is where we set new neighbors and stuff
                     td = (now - bts.last_cycle_time)
                     logging.debug("BTS %d td=%s, cycle=%d" % (bts.id_num, td.seconds, self.NEIGHBOR_CYCLE_TIME))
+                    neighbor_port = 16002 if bts.id_num==0 else 16001
+                    real = ["127.0.0.1:%d" % neighbor_port]
                     if td.seconds > self.NEIGHBOR_CYCLE_TIME:
-                        if bts.id_num == 0:
-                            new_neighbors = [30, 40]
-                        else:
-                            new_neighbors = [20, 40]
+                        new_neighbors = self.pick_new_neighbors(bts.id_num, testing=False)
                         logging.info("New neighbors (BTS %d): %s" % (bts.id_num, new_neighbors))
 
-                        neighbor_port = 16002 if bts.id_num==0 else 16001
-                        bts.set_neighbors(new_neighbors, neighbor_port, num_real=1)
+                        bts.set_neighbors(new_neighbors, self.gsmwsdb, real=real)
                         bts.decoder.ignore_reports = True
                         bts.ignored_since = now
                         bts.last_cycle_time = now
 
-                    # continually do this so OpenBTS doesn't delete these
-                    if restarted:
-                        bts.set_neighbors(bts.neighbors, neighbor_port, num_real=1)
+                    # OpenBTS can come back from a restart without these, so
+                    # once it's up, send them again; verify makes it re-read
+                    # the NeighborTable rows rather than trust what we sent
+                    # last. Once is enough: set_neighbors only sends changes.
+                    if bts.id_num in restarted:
+                        bts.set_neighbors(bts.neighbors, self.gsmwsdb, real=real, verify=True)
+                        restarted.discard(bts.id_num)
 
                     rssis = bts.decoder.rssi()
                     self.update_rssi_db(rssis)
@@ -332,26 +606,51 @@ class HandoverController(Controller):
                 # BTS.
                 to_restart = set()
 
-                arfcn_to_bts = dict(zip([b.current_arfcn for b in self.bts_units], [b for b in self.bts_units]))
+                arfcn_to_bts = dict((self.c0s[b.id_num], b) for b in self.bts_units)
                 reports = []
                 for bts in self.bts_units:
-                    reports += bts.reports
+                    if not bts.restarting:
+                        reports += bts.reports("controller")
 
                 for r in reports:
                     for t in r:
-                        if t in arfcn_to_bts:
+                        if t in arfcn_to_bts and not arfcn_to_bts[t].restarting:
                             logging.debug("Report bts %d (ARFCN %s) is_off=%s report=%d"
                                           % (arfcn_to_bts[t].id_num, t, arfcn_to_bts[t].is_off(), r[t]))
 
-                            # 10 is a good threshold... could be set lower, but w/e
-                            if r[t] > 10 and arfcn_to_bts[t].is_off():
+                            # 10 (the default MAX_DELTA) is a good threshold... could be set lower, but w/e
+                            if r[t] > self.MAX_DELTA and arfcn_to_bts[t].is_off():
                                 to_restart |= set([arfcn_to_bts[t],])
+                                self.planner.threaten(arfcn_to_bts[t].id_num, t,
+                                                      "RXLEV %d while off" % r[t])
+
+                # and anything the co-channel check has flagged
+                for bts in self.bts_units:
+                    if self.planner.threatened(bts.id_num, self.c0s[bts.id_num]):
+                        to_restart.add(bts)
 
                 logging.info("to_restart: %s" % (to_restart))
-                # kill what needs to be killed
+                # kill what needs to be killed, if the planner agrees and has
+                # somewhere safe to put it. This doesn't block: the BTS
+                # restarts in the background while we keep running the others.
+                observations = None
                 for bts in to_restart:
-                    bts.change_arfcn(bts.current_arfcn + 10, True)
-
-                time.sleep(self.SLEEP_TIME)
+                    if bts.restarting:
+                        continue
+                    if observations is None:
+                        observations = self.observations()
+                    current = self.c0s[bts.id_num]
+                    others = [self.c0s[b.id_num] for b in self.bts_units if b is not bts]
+                    new_arfcn = self.planner.plan(bts.id_num, current, observations,
+                                                  reserved=others,
+                                                  regional=self.regional_safe_arfcns())
+                    if new_arfcn is None:
+                        continue
+                    if bts.change_arfcn(new_arfcn, True):
+                        self.planner.changed(bts.id_num, current, new_arfcn)
+                        self.c0s[bts.id_num] = new_arfcn
+                        restarted.add(bts.id_num)
+
+                self.stopped.wait(self.SLEEP_TIME)
             except KeyboardInterrupt:
                 break
@@ -13,6 +13,10 @@ import sqlite3
 import zmq
 from sets import Set
 
+from profiling import timers
+import ringbuffer
+import cochannel
+
 class MeasurementReportList(object):
     def __init__(self, maxlen=10000):
         self.lock = threading.Lock()
@@ -25,7 +29,7 @@ class MeasurementReportList(object):
 
     def get(self):
         with self.lock:
-            self.reports.popleft()
+            return self.reports.popleft()
 
     def getall(self):
         with self.lock:
@@ -69,9 +73,13 @@ class GSMDecoder(threading.Thread):
     This is responsible for managing the packet stream from tshark, processing
     reports, and storing the data.
     """
+    # the messages process() handles, as named in filters.MESSAGES. Every
+    # decoder handles exactly these, and capture filters are built from them
+    # at startup, so keep them in sync with process().
+    HANDLERS = ["measurement_report", "system_information_2"]
 
-
-    def __init__(self, stream, db_lock, gsmwsdb_location, nct, maxlen=100, loglvl=logging.INFO, decoder_id=0):
+    def __init__(self, stream, db_lock, gsmwsdb_location, nct, maxlen=100, loglvl=logging.INFO, decoder_id=0,
+                 publisher=None, report_capacity=10000):
         threading.Thread.__init__(self)
         self.stream = stream
         self.current_message = ""
@@ -79,6 +87,10 @@ class GSMDecoder(threading.Thread):
         self.num_of_cells = None
         self.last_arfcns = []
         self.ncc_permitted = None
+        self.neighbors_changed_at = None # when SI2 last told us something new
+        self.neighbor_listeners = [] # called as fn(decoder, old, new) on change
+        self.parse_cache = gsm.ParseCache()
+        self.cochannel = cochannel.CoChannelDetector() # foreign BSICs on our channels
         self.ignore_reports = False # ignore measurement reports
         self.msgs_seen = 0
 
@@ -97,7 +109,9 @@ class GSMDecoder(threading.Thread):
 
         self.rssi_queue = Queue.Queue()
 
-        self.reports = MeasurementReportList()
+        # shared by everyone who reads reports; each reader has its own cursor
+        self.reports = ringbuffer.ReportRing(report_capacity)
+        self.publisher = publisher # a publisher.ReportPublisher, if we push reports
 
         self.strengths_maxlen = maxlen
         self.max_strengths = {} # max strength ever seen for a given arfcn
@@ -106,6 +120,26 @@ class GSMDecoder(threading.Thread):
         logging.warn("GSMDecoder is deprecated! Use at your own risk.")
 
 
+    def add_neighbor_listener(self, fn):
+        """ fn(decoder, old_arfcns, new_arfcns) is called whenever the SI2
+        neighbor list changes. """
+        self.neighbor_listeners.append(fn)
+
+    def neighbors_changed(self, sysinfo2):
+        """
+        SI2 has a different neighbor list (or NCC permitted) than before.
+        Everything that depends on last_arfcns should hang off of here rather
+        than noticing on its own.
+        """
+        old = self.last_arfcns
+        self.last_arfcns = sysinfo2.arfcns
+        self.ncc_permitted = sysinfo2.ncc_permitted
+        self.neighbors_changed_at = time.time()
+        logging.info("(decoder %d) SystemInformation2 neighbors changed: %s -> %s"
+                     % (self.decoder_id, old, sysinfo2.arfcns))
+        for fn in self.neighbor_listeners:
+            fn(self, old, sysinfo2.arfcns)
+
     def _populate_strengths(self):
         """
         Rather than storing our history, we can just store the current mean for
@@ -127,7 +161,7 @@ class GSMDecoder(threading.Thread):
 
     def __write_rssi(self):
         if not self.rssi_queue.empty():
-            with self.gsmwsdb_lock:
+            with timers.timed("decoder.db_flush"), self.gsmwsdb_lock:
                 while not self.rssi_queue.empty():
                     try:
                         query = self.rssi_queue.get()
@@ -137,23 +171,45 @@ class GSMDecoder(threading.Thread):
                 self.gsmwsdb.commit()
 
 
-    def rssi(self):
+    def _averages(self):
         # returns a dict with a weighted average of each arfcn
         # we base this only on last known data for an ARFCN -- lack of report
         # doesn't mean anything, but if an arfcn is in the neighbor list and we
         # don't get a report for it, we count that as -1.
+        # Also returns {arfcn: (average of recent reports, how many)}.
 
         res = {}
-        now = datetime.datetime.now()
+        recent_avgs = {}
+
+        # The controller calls this from its own thread while we're updating
+        # these, so work from copies, and skip ARFCNs that are only half added
+        # (or removed).
+        max_strengths = dict(self.max_strengths)
+        recent_strengths = dict(self.recent_strengths)
+        for arfcn in max_strengths:
+            if arfcn not in recent_strengths:
+                continue
+            recent = list(recent_strengths[arfcn])
+            if len(recent) == 0:
+                continue
+            tot = max_strengths[arfcn] + sum(recent)
+            res[arfcn] = float(tot) / (1 + len(recent))
+            recent_avgs[arfcn] = (sum(recent) / float(len(recent)), len(recent))
+
+        return res, recent_avgs
+
+    def averages(self):
+        """ What rssi() returns, without queueing anything for the DB. """
+        return self._averages()[0]
 
-        for arfcn in self.max_strengths:
-            tot = self.max_strengths[arfcn] + sum(self.recent_strengths[arfcn])
-            res[arfcn] = float(tot) / (1 + len(self.recent_strengths[arfcn]))
+    def rssi(self):
+        res, recent_avgs = self._averages()
 
-            # now, update the db
-            recent_avg = sum(self.recent_strengths[arfcn]) / float(len(self.recent_strengths[arfcn]))
+        # now, update the db
+        now = datetime.datetime.now()
+        for arfcn, (recent_avg, count) in recent_avgs.items():
             self.rssi_queue.put(("DELETE FROM AVG_STRENGTHS WHERE ARFCN=?", (arfcn,)))
-            self.rssi_queue.put(("INSERT INTO AVG_STRENGTHS VALUES (?, ?, ?, ?)", (now, arfcn, recent_avg, len(self.recent_strengths[arfcn]))))
+            self.rssi_queue.put(("INSERT INTO AVG_STRENGTHS VALUES (?, ?, ?, ?)", (now, arfcn, recent_avg, count)))
 
         return res
 
@@ -169,13 +225,22 @@ class GSMDecoder(threading.Thread):
         # breaking every time we find a line that is unindented. Unindented
         # line = new message. The message is then handed off to process(),
         # which extracts relevant information from it.
+        #
+        # Framing time is summed up per message rather than timed per line, to
+        # keep the always-on timers cheap.
+        framing = 0.0
         for line in self.stream:
             self.__write_rssi()
+            start = time.time()
             if line.startswith("    "):
                 #print "appending"
                 self.current_message += "%s" % line
+                framing += time.time() - start
             else:
-                self.process(self.current_message)
+                timers.record("decoder.framing", framing + time.time() - start)
+                framing = 0.0
+                with timers.timed("decoder.process"):
+                    self.process(self.current_message)
                 self.current_message = line
 
     def update_strength(self, strengths):
@@ -183,7 +248,7 @@ class GSMDecoder(threading.Thread):
         self.update_recent_strengths(strengths)
 
     def update_max_strength(self, strengths):
-        with self.gsmwsdb_lock:
+        with timers.timed("decoder.db_max_strength"), self.gsmwsdb_lock:
             for arfcn in strengths:
                 value = strengths[arfcn]
                 now = datetime.datetime.now()
@@ -235,6 +300,8 @@ class GSMDecoder(threading.Thread):
     def process(self, message):
         logging.info("In Decoder process")
         self.msgs_seen += 1
+        if self.publisher is not None and self.publisher.summary_due(self.decoder_id):
+            self.publisher.publish_summaries(self.decoder_id, self.recent_strengths, self.max_strengths)
         if message.startswith("GSM A-I/F DTAP - Measurement Report"):
             logging.info("In Decoder Measurement Report")
             if self.ignore_reports or self.current_arfcn is None or len(self.last_arfcns) == 0:
@@ -243,15 +310,16 @@ class GSMDecoder(threading.Thread):
             report = gsm.MeasurementReport(self.last_arfcns, self.current_arfcn, message)
             if report.valid:
                 logging.info("(decoder %d) MeasurementReport: " % (self.decoder_id) + str(report))
-                self.reports.put(report.current_strengths)
+                self.reports.put(report.current_strengths, self.decoder_id)
+                if self.publisher is not None:
+                    self.publisher.publish_report(self.decoder_id, self.current_arfcn, report.current_strengths)
              # removed the for loop from here
                 self.update_max_strength(report.current_strengths)
                 self.update_recent_strengths(report.current_strengths)
 
-                for arfcn in report.current_bsics:
-                    if report.current_bsics[arfcn] != None:
-                        logging.debug("ZOUNDS! AN ENEMY BSIC: %d (ARFCN %d, decoder %d)" % (report.current_bsics[arfcn], arfcn, self.decoder_id))
-                        
+                # any BSIC that isn't who we expect on that ARFCN
+                self.cochannel.observe_report(report, self.current_arfcn)
+
             #gsmtap = gsm.GSMTAP(message)
             #neighbor_details = report.neighbor_details
             #if self.runtime["initial_time"] == None:
@@ -293,12 +361,14 @@ class GSMDecoder(threading.Thread):
             #                    self.gsmwsdb.execute("INSERT INTO AVAIL_ARFCN VALUES(?,?,?)",
             #                                     (tracker, timestamp, self.runtime["rssis"][self.runtime["arfcn_tracking"].index(tracker)]))
         elif message.startswith("GSM CCCH - System Information Type 2"):
-            sysinfo2 = gsm.SystemInformationTwo(message)
-            self.last_arfcns = sysinfo2.arfcns
-            self.ncc_permitted = sysinfo2.ncc_permitted
-            logging.debug("(decoder %d) SystemInformation2: %s" % (self.decoder_id, str(sysinfo2.arfcns)))
+            # almost always the same SI2 as last time; see gsm.ParseCache
+            sysinfo2 = self.parse_cache.get(gsm.SystemInformationTwo, message)
+            if (sysinfo2.arfcns != self.last_arfcns
+                    or sysinfo2.ncc_permitted != self.ncc_permitted):
+                self.neighbors_changed(sysinfo2)
         elif message.startswith("GSM TAP Header"):
-            gsmtap = gsm.GSMTAP(message)
-            self.current_arfcn = gsmtap.arfcn
-            logging.debug("(decoder %d) GSMTAP: Current ARFCN=%s" % (self.decoder_id, str(gsmtap.arfcn)))
+            gsmtap = self.parse_cache.get(gsm.GSMTAP, message, gsm.gsmtap_key(message))
+            if gsmtap.arfcn != self.current_arfcn:
+                logging.debug("(decoder %d) GSMTAP: Current ARFCN=%s" % (self.decoder_id, str(gsmtap.arfcn)))
+                self.current_arfcn = gsmtap.arfcn
 
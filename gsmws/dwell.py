@@ -0,0 +1,134 @@
+"""
+This file is part of GSMWS.
+"""
+
+import math
+import time
+import logging
+
+"""
+Adaptive dwell for neighbor scans. We used to watch each neighbor set for a
+fixed NEIGHBOR_CYCLE_TIME, and ignore reports for a fixed 120s after changing
+it. Most channels are obviously idle (or obviously busy) after a few dozen
+reports, so that's a lot of time spent learning nothing.
+
+Instead, every ARFCN in the current set gets a sequential probability ratio
+test on its RXLEV samples (see SPRT), and we move on to the next set as soon as
+they've all made up their minds -- but never before min_cycle and never after
+max_cycle. And rather than a fixed ignore window, we stop ignoring reports as
+soon as the decoder sees an SI2 with the new neighbor set in it (the decoder's
+neighbor listener), with ignore_timeout as a fallback in case we never do.
+"""
+
+IDLE = "idle"
+BUSY = "busy"
+
+class SPRT(object):
+    """
+    Wald's sequential probability ratio test on the mean RXLEV of one ARFCN:
+    idle (mean RXLEV idle) vs busy (mean RXLEV busy), assuming Gaussian
+    readings with standard deviation sigma. alpha and beta are the error rates
+    we'll put up with for calling an idle channel busy and a busy one idle.
+    """
+    def __init__(self, idle=2.0, busy=10.0, sigma=6.0, alpha=0.01, beta=0.01,
+                 min_samples=24):
+        self.lower = math.log(beta / (1.0 - alpha))
+        self.upper = math.log((1.0 - beta) / alpha)
+        self.slope = (busy - idle) / float(sigma ** 2)
+        self.midpoint = (idle + busy) / 2.0
+        self.min_samples = min_samples
+        self.llr = 0.0
+        self.samples = 0
+        self.decision = None
+
+    def add(self, rxlev):
+        if self.decision is not None:
+            return self.decision
+        # listed but not reported (-0.001 in the decoder) means we didn't hear it
+        rxlev = max(0.0, rxlev)
+        self.llr += self.slope * (rxlev - self.midpoint)
+        self.samples += 1
+        if self.samples >= self.min_samples:
+            if self.llr <= self.lower:
+                self.decision = IDLE
+            elif self.llr >= self.upper:
+                self.decision = BUSY
+        return self.decision
+
+class AdaptiveDwell(object):
+    """
+    Decides when the controller has watched the current neighbor set for long
+    enough. Call begin() whenever the neighbor set changes, update() every
+    tick, and move on when due() says so.
+    """
+    def __init__(self, bts, min_cycle=60, max_cycle=300, ignore_timeout=120,
+                 consumer="dwell", **sprt_args):
+        self.bts = bts
+        self.min_cycle = min_cycle
+        self.max_cycle = max_cycle
+        self.ignore_timeout = ignore_timeout
+        self.consumer = consumer
+        self.sprt_args = sprt_args
+        self.tests = {}
+        self.expected = None # neighbor set we're waiting for SI2 to show
+        self.started = None
+        self.ignored_since = None
+
+    def begin(self, arfcns, now=None):
+        """ We just asked for arfcns as the new neighbor set. """
+        if now is None:
+            now = time.time()
+        self.tests = dict((arfcn, SPRT(**self.sprt_args)) for arfcn in arfcns)
+        self.expected = set(arfcns)
+        self.started = now
+        self.ignored_since = now
+        self.bts.decoder.ignore_reports = True
+        # anything still in the ring is about the old set
+        cursor = self.bts.decoder.reports.cursor(self.consumer)
+        cursor.position = self.bts.decoder.reports.seq
+
+    def neighbors_changed(self, decoder, old, new):
+        """ Decoder neighbor listener: SI2 changed. """
+        if self.expected is None or not self.expected <= set(new):
+            return
+        if self.bts.restarting:
+            # the restart puts ignore_reports back as it found it (on), so
+            # leave expected for update() to clear once OpenBTS is back
+            return
+        elapsed = time.time() - self.ignored_since
+        logging.info("New neighbor set in SI2 after %.1fs, using reports again" % elapsed)
+        self.expected = None
+        decoder.ignore_reports = False
+
+    def update(self, now=None):
+        """ Feed new reports to the tests. """
+        if now is None:
+            now = time.time()
+        decoder = self.bts.decoder
+        if (self.expected is not None and not self.bts.restarting
+                and now - self.ignored_since > self.ignore_timeout):
+            logging.warning("Never saw %s in SI2, using reports anyway"
+                            % sorted(self.expected))
+            self.expected = None
+            decoder.ignore_reports = False
+        for strengths in self.bts.reports(self.consumer):
+            for arfcn, test in self.tests.items():
+                if arfcn in strengths:
+                    test.add(strengths[arfcn])
+
+    def settled(self):
+        return all(t.decision is not None for t in self.tests.values())
+
+    def due(self, now=None):
+        if self.started is None:
+            return True
+        if now is None:
+            now = time.time()
+        elapsed = now - self.started
+        if elapsed >= self.max_cycle:
+            return True
+        return elapsed >= self.min_cycle and self.settled()
+
+    def summary(self):
+        """ {arfcn: (decision, samples)} for the current set. """
+        return dict((arfcn, (t.decision, t.samples)) for arfcn, t in self.tests.items())
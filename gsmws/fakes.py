@@ -0,0 +1,207 @@
+"""
+This file is part of GSMWS.
+
+Stand-ins for the pieces of a real OpenBTS install, so we can exercise GSMWS
+on a machine without a radio attached.
+"""
+
+import os
+import time
+import random
+import socket
+import logging
+import threading
+
+import cmdsocket
+import api
+
+class FakeCommandServer(threading.Thread):
+    """
+    Pretends to be the OpenBTS command socket. Every datagram we get is handed
+    to handler(command) and whatever it returns is sent back to the sender.
+    The default handler just echoes "OK". Set delay to make us slow (to test
+    timeouts), and look at self.commands to see what we've been asked to do.
+    """
+    def __init__(self, path, handler=None, delay=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.handler = handler or (lambda command: "OK")
+        self.delay = delay
+        self.commands = []
+        self.stopped = threading.Event()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(0.1)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data, sender = self.sock.recvfrom(cmdsocket.BUFSIZE)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            command = data.decode('utf-8').rstrip('\0')
+            self.commands.append(command)
+            if self.delay:
+                self.stopped.wait(self.delay)
+            response = self.handler(command)
+            if response is None:
+                continue # don't answer at all
+            try:
+                self.sock.sendto(response.encode('utf-8') + b'\0', sender)
+            except socket.error as e:
+                # client went away, probably because it timed out on us
+                logging.debug("FakeCommandServer: can't answer %s (%s)"
+                              % (sender, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class FakeGSMWSNode(object):
+    """
+    A stand-in gsmwsd that only knows how to answer occupancy() (what the
+    aggregator polls). Change what it reports with observe() and forget().
+    """
+    def __init__(self, host="localhost", port=0, delay=0):
+        self.log = api.OccupancyLog()
+        self.observations = {}
+        self.delay = delay
+        self.server = api.ThreadedXMLRPCServer((host, port))
+        self.server.register_function(self.occupancy, "occupancy")
+        self.url = "http://%s:%d" % self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def observe(self, arfcn, rssi, timestamp="2014-01-01 00:00:00"):
+        self.observations[arfcn] = (rssi, timestamp)
+        self.log.update(self.observations)
+
+    def forget(self, arfcn):
+        del self.observations[arfcn]
+        self.log.update(self.observations)
+
+    def occupancy(self, since=0, epoch=None):
+        if self.delay:
+            threading.Event().wait(self.delay)
+        return self.log.since(since, epoch)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeBTS(object):
+    """
+    Enough of bts.BTS for Controller.main to run against, with no OpenBTS.
+    Pair it with synthetic_stream(), which reads the neighbor list and C0 off
+    of it so SI2 follows set_neighbors() like it would for real.
+    """
+    def __init__(self, c0=51, bsic=17, loglvl=logging.INFO, cmd_socket=None,
+                 node_manager_address=None, restart_cmd=None):
+        self.c0 = c0
+        self.cmd_socket = cmd_socket
+        self.node_manager_address = node_manager_address
+        self._bsic = bsic
+        self.neighbors = []
+        self.decoder = None
+        self.restarting = False
+        self.changes = 0
+
+    def init_decoder(self, gsm_decoder):
+        self.decoder = gsm_decoder
+        self.decoder.start()
+
+    def current_arfcn(self):
+        return self.c0
+
+    def bsic(self):
+        return self._bsic
+
+    def txatten(self):
+        return 0
+
+    def is_off(self):
+        return False
+
+    def offset_correct(self):
+        return True
+
+    def reports(self, consumer="default"):
+        return self.decoder.reports.cursor(consumer).reports()
+
+    def set_neighbors(self, arfcns, gsmws_db, real=[], verify=False):
+        self.neighbors = list(arfcns)
+        return True
+
+    def change_arfcn(self, new_arfcn, immediate=False):
+        self.c0 = int(new_arfcn)
+        self.changes += 1
+        return True
+
+def _measurement_report(bts, rxlevs):
+    """ tshark -V style Measurement Report for the first six neighbors. """
+    lines = ["GSM A-I/F DTAP - Measurement Report",
+             "    Measurement Results",
+             "        ..01 0000 = RXLEV-FULL-SERVING-CELL: -95 <= x < -94 dBm (%d)" % rxlevs.get(bts.c0, 30),
+             "        .... ...0  01.. .... = NO-NCELL-M: %d neighbour cell measurement result (%d)"]
+    reported = 0
+    # BCCH-FREQ-NCELL indexes the SI2 list, which is sorted
+    for i, arfcn in enumerate(sorted(bts.neighbors)[:6]):
+        if arfcn not in rxlevs:
+            continue
+        lines += ["        ..01 0001 = RXLEV-NCELL: %d" % rxlevs[arfcn],
+                  "        0001 0... = BCCH-FREQ-NCELL: %d" % i,
+                  "        .... .000  010. .... = BSIC-NCELL: %d" % random.randint(0, 63)]
+        reported += 1
+    lines[3] = lines[3] % (reported, reported)
+    return lines
+
+def synthetic_stream(bts, rate=2.0, busy=(), si2_every=20, stopped=None):
+    """
+    Generates tshark -V lines for a BTS with one phone attached, sending rate
+    Measurement Reports a second (a phone sends about 2), with an SI2 every
+    si2_every reports. ARFCNs in busy are reported strongly, others are
+    usually not heard at all. Runs until stopped (a threading.Event) is set.
+    """
+    n = 0
+    interval = 1.0 / rate
+    next_time = time.time()
+    while stopped is None or not stopped.is_set():
+        n += 1
+        if n % si2_every == 1:
+            yield "Frame %d: 81 bytes on wire\n" % n
+            yield "GSM TAP Header, ARFCN: %d (Downlink), TS: 0, Channel: BCCH (0)\n" % bts.c0
+            yield "GSM CCCH - System Information Type 2\n"
+            yield "    List of ARFCNs = %s\n" % " ".join([str(a) for a in sorted(bts.neighbors)])
+            yield "    NCC Permitted\n"
+            yield "        1111 1111 = NCC Permitted: 0xff\n"
+        rxlevs = {}
+        for arfcn in bts.neighbors:
+            if arfcn in busy:
+                rxlevs[arfcn] = random.randint(15, 40)
+            elif random.random() < 0.05:
+                rxlevs[arfcn] = random.randint(0, 3)
+        yield "Frame %d: 81 bytes on wire\n" % n
+        yield "GSM TAP Header, ARFCN: %d (Uplink), TS: 1, Channel: SACCH/F (1)\n" % bts.c0
+        for line in _measurement_report(bts, rxlevs):
+            yield line + "\n"
+
+        next_time += interval
+        delay = next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            next_time = time.time() # can't keep up; don't try to catch up
+    yield "Frame 0: end\n" # so the decoder processes the last message
@@ -0,0 +1,108 @@
+"""
+This file is part of GSMWS.
+"""
+
+"""
+Capture filters built from what the decoder actually reads. The default
+capture was "udp dst port 4729" on any interface, so tshark dissected every
+GSMTAP packet OpenBTS sent -- paging, SI1/3/4, the lot -- only for
+GSMDecoder.process to throw nearly all of it away. All it wants is SI2 (the
+neighbor list) and Measurement Reports, plus the GSMTAP header that comes with
+every packet anyway.
+
+capture_filter() and display_filter() turn a set of handlers (names from
+MESSAGES) and the BTS addresses GSMTAP goes to into:
+
+    - a kernel BPF capture filter, so everything else is dropped before it
+      gets anywhere near tshark. It matches on the GSMTAP header (UDP payload
+      starts at udp[8]):
+
+        udp[8+2]      type; 1 is GSM Um
+        udp[8+4]      ARFCN high byte; 0x40 is the uplink flag
+        udp[8+12]     sub-type; 1 is BCCH, 0x80 the ACCH (SACCH) flag
+        udp[8+1]      header length in 32-bit words, so the Um payload
+                      starts at udp[8 + udp[9]*4]. For BCCH that's an L2
+                      pseudo length, the RR protocol discriminator and then
+                      the message type (SI2 is 0x1a).
+
+      Measurement Reports come up on the SACCH, uplink. We don't dig into
+      the LAPDm header for their message type; uplink SACCH is nearly all
+      reports anyway, and the display filter sorts out the rest.
+
+    - a tshark display filter on the RR message type, for exactly the
+      messages we handle.
+
+Both are built once, at startup, and fixed for the life of the capture. The
+handlers are GSMDecoder.HANDLERS, which every decoder handles (there's no
+per-decoder set to drift from them), and the addresses are the --bts-map the
+demultiplexer routes by. Neither changes while the controller runs; changing
+either means restarting it, which restarts the capture anyway.
+"""
+
+GSMTAP_PORT = 4729
+
+# udp[] offsets of GSMTAP header fields
+GSMTAP_HDR_LEN = 8 + 1
+GSMTAP_TYPE = 8 + 2
+GSMTAP_ARFCN_HIGH = 8 + 4
+GSMTAP_SUB_TYPE = 8 + 12
+
+GSMTAP_TYPE_UM = 0x01
+GSMTAP_UPLINK = 0x40
+GSMTAP_CHANNEL_BCCH = 0x01
+GSMTAP_CHANNEL_ACCH = 0x80
+
+# start of the Um payload, after the (variable length) GSMTAP header
+PAYLOAD = "8 + udp[%d] * 4" % GSMTAP_HDR_LEN
+
+RR_SYSTEM_INFORMATION_2 = 0x1a
+RR_MEASUREMENT_REPORT = 0x15
+
+# what we can filter on for each message the decoder handles
+MESSAGES = {
+    "system_information_2": {
+        "bpf": ("udp[%d] == 0x%02x and udp[%d] & 0x%02x == 0 and udp[%s + 2] == 0x%02x"
+                % (GSMTAP_SUB_TYPE, GSMTAP_CHANNEL_BCCH, GSMTAP_ARFCN_HIGH, GSMTAP_UPLINK,
+                   PAYLOAD, RR_SYSTEM_INFORMATION_2)),
+        "display": "gsm_a.dtap.msg_rr_type == 0x%02x" % RR_SYSTEM_INFORMATION_2,
+    },
+    "measurement_report": {
+        "bpf": ("udp[%d] & 0x%02x != 0 and udp[%d] & 0x%02x != 0"
+                % (GSMTAP_ARFCN_HIGH, GSMTAP_UPLINK, GSMTAP_SUB_TYPE, GSMTAP_CHANNEL_ACCH)),
+        "display": "gsm_a.dtap.msg_rr_type == 0x%02x" % RR_MEASUREMENT_REPORT,
+    },
+}
+
+def address_filter(addresses):
+    """
+    BPF for GSMTAP going to any of addresses: (address, port or None) pairs,
+    like the keys of capture.parse_bts_map. No addresses means any address.
+    """
+    if not addresses:
+        return "udp dst port %d" % GSMTAP_PORT
+    clauses = []
+    for addr, port in sorted(addresses, key=lambda a: (a[0], a[1] or 0)):
+        clauses.append("(ip dst %s and udp dst port %d)" % (addr, port or GSMTAP_PORT))
+    if len(clauses) == 1:
+        return clauses[0]
+    return "(%s)" % " or ".join(clauses)
+
+def capture_filter(handlers, addresses=()):
+    """ The kernel BPF filter for handlers (names from MESSAGES). """
+    unknown = sorted(set(handlers) - set(MESSAGES))
+    if unknown:
+        raise ValueError("no filter for handlers: %s" % ", ".join(unknown))
+    if not handlers:
+        raise ValueError("no handlers, so nothing to capture")
+    messages = " or ".join("(%s)" % MESSAGES[h]["bpf"] for h in sorted(handlers))
+    return "%s and udp[%d] == 0x%02x and (%s)" % (address_filter(addresses), GSMTAP_TYPE,
+                                                 GSMTAP_TYPE_UM, messages)
+
+def display_filter(handlers):
+    """ The tshark display filter for handlers. """
+    return " || ".join(MESSAGES[h]["display"] for h in sorted(handlers))
+
+def command(handlers, addresses=(), interface="any", tshark="tshark"):
+    """ A tshark command line (as a list) using both filters. """
+    return [tshark, "-V", "-n", "-i", interface, "-f", capture_filter(handlers, addresses),
+            "-Y", display_filter(handlers)]
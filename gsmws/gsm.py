@@ -4,6 +4,8 @@ This file is part of GSMWS.
 
 import subprocess
 import sys
+import collections
+import threading
 import datetime
 import re
 import logging
@@ -26,20 +28,88 @@ well as a moving average of the RSSI for each.
 
 regex = {'current_strength': re.compile("RXLEV-FULL-SERVING-CELL:.*dBm \((\d+)\)"),
          'num_cells': re.compile("NO-NCELL-M:.*result \((\d+)\)"),
-         'cell_report': re.compile("RXLEV-NCELL: (\d+)\n.*= BCCH-FREQ-NCELL: (\d+)\n.* = BSIC-NCELL: (\d)"),
+         'cell_report': re.compile("RXLEV-NCELL: (\d+)\n.*= BCCH-FREQ-NCELL: (\d+)\n.* = BSIC-NCELL: (\d+)"),
          'arfcn': re.compile("GSM TAP Header, ARFCN: (\d+)"),
          'sys_info_2': re.compile("List of ARFCNs =([ \d]+).*(\d{4} \d{4}) = NCC Permitted",re.DOTALL),
          }
 def command_stream(command):
-    cmd_list = command.split()
+    """ stdout of command: a string, or a list if arguments have spaces in them. """
+    if hasattr(command, "split"):
+        cmd_list = command.split()
+    else:
+        cmd_list = list(command)
     proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE)
     return proc.stdout
 
+def messages(stream):
+    """
+    Split tshark -V output into messages: an unindented line starts a new
+    message, and indented lines belong to the current one. This is the same
+    framing GSMDecoder.run does.
+    """
+    current = []
+    for line in stream:
+        if line.startswith("    "):
+            current.append(line)
+        else:
+            if current:
+                yield "".join(current)
+            current = [line]
+    if current:
+        yield "".join(current)
+
+class ParseCache(object):
+    """
+    A small LRU cache of parsed messages. SI2 and the GSMTAP header repeat
+    constantly with identical content, so there's no point running the regexes
+    on them every time. Keys are the message body (so the lookup is a hash of
+    it); for GSMTAP we only key on the header line, since that's all we parse
+    and the rest (frame number etc) changes every packet.
+
+    Cached objects are shared, so don't modify them. Their timestamp is when
+    we first parsed that content.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cls, message, key=None):
+        """ Return cls(message), reusing an earlier parse of the same content. """
+        if key is None:
+            key = message
+        key = (cls, key)
+        with self.lock:
+            parsed = self.entries.pop(key, None)
+            if parsed is not None:
+                self.hits += 1
+                self.entries[key] = parsed # most recently used goes last
+                return parsed
+            self.misses += 1
+        parsed = cls(message)
+        with self.lock:
+            self.entries[key] = parsed
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return parsed
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries)}
+
+def gsmtap_key(message):
+    """ The part of a GSMTAP message GSMTAP.parse() actually looks at. """
+    return message.split("\n", 1)[0]
+
 class MeasurementReport(object):
     def __init__(self, last_arfcns, current_arfcn, result_msg):
         self.timestamp = datetime.datetime.now()
         self.result_msg = result_msg
         self.valid = False
+        self.own_bsics = [] # BSICs reported on our own C0, see parse()
         self.current_strengths, self.current_bsics = self.parse(last_arfcns, current_arfcn)
         self.neighbor_details = self.get_arfcns()
 
@@ -87,11 +157,13 @@ GSM A-I/F DTAP - Measurement Report
             #print int(report[0])
             strengths[last_arfcns[int(report[1])]] = int(report[0])
             if not current_arfcn == last_arfcns[int(report[1])]:
-                # TODO: ignore current arfcn bsic for now. This could be a good
-                # way to detect same-channel interference w/ a single ARFCN: if
-                # the measurement report doesn't match our current BSIC then we
-                # can safely assume we're seeing another tower!
                 bsics[last_arfcns[int(report[1])]] = int(report[2])
+            else:
+                # Our own C0 is in the neighbor list. If the BSIC the phone
+                # heard on it isn't ours, there's another tower on our
+                # channel (see cochannel.py). Kept out of current_bsics,
+                # which is about other ARFCNs.
+                self.own_bsics.append(int(report[2]))
 
         self.valid = True
         return strengths, bsics
@@ -0,0 +1,141 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import sqlite3
+import logging
+
+"""
+OpenBTS keeps its handover neighbors in a small sqlite DB (NeighborTable.db,
+set by Peering.NeighborTable.Path) and reads it constantly. We write our fake
+neighbors directly into the same table, so we need to be quick about it: any
+time we hold the write lock, OpenBTS's handover logic waits on us.
+
+So rather than DELETE everything and reinsert row by row, we remember what we
+last wrote, work out which rows actually changed, and push just those with
+executemany in one short transaction. We take the write lock up front (BEGIN
+IMMEDIATE) with a short busy timeout, and if OpenBTS has the lock we back off
+and try again rather than waiting on it.
+"""
+
+class NeighborTableWriter(object):
+    """
+    Keeps the NEIGHBOR_TABLE rows for the IPs we manage in sync with what we
+    want. Rows are {ip: (c0, bsic)}; we never touch rows for IPs we weren't
+    asked to manage (e.g., real neighbors OpenBTS fills in itself).
+    """
+    def __init__(self, path, busy_timeout=0.1, retries=5, retry_delay=0.05,
+                 holdoff=3600*24*7):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.holdoff = holdoff # GSM.Handover.FailureHoldoff for our fakes
+
+        # isolation_level=None: we do our own BEGIN/COMMIT
+        self.conn = sqlite3.connect(path, timeout=busy_timeout,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA busy_timeout = %d" % int(busy_timeout * 1000))
+
+        self.expected = {} # ip -> (c0, bsic, holdoff), as we last wrote it
+        self.loaded = False
+
+    def load(self, ips=None):
+        """ Read back what's in the table for ips (default: everything we
+        manage), so the next sync() fixes anything OpenBTS changed. """
+        if ips is None:
+            ips = list(self.expected.keys())
+        ips = list(ips)
+        current = {}
+        if len(ips) > 0:
+            query = ("SELECT IPADDRESS, C0, BSIC, HOLDOFF FROM NEIGHBOR_TABLE "
+                     "WHERE IPADDRESS IN (%s)" % ",".join(["?"] * len(ips)))
+            for ip, c0, bsic, holdoff in self._retry(
+                    lambda: self.conn.execute(query, ips).fetchall()):
+                current[ip] = (c0, bsic, holdoff)
+        for ip in ips:
+            if ip in current:
+                self.expected[ip] = current[ip]
+            elif ip in self.expected:
+                del self.expected[ip]
+        self.loaded = True
+        return current
+
+    def diff(self, rows):
+        """
+        Returns:
+            (deletes, upserts): IPs we wrote before but don't want any more,
+            and {ip: (c0, bsic, holdoff)} for rows that are new or changed.
+        """
+        wanted = dict((ip, (c0, bsic, self.holdoff))
+                      for ip, (c0, bsic) in rows.items())
+        deletes = [ip for ip in self.expected if ip not in wanted]
+        upserts = dict((ip, row) for ip, row in wanted.items()
+                       if self.expected.get(ip) != row)
+        return deletes, upserts
+
+    def _retry(self, fn):
+        """ Run fn, backing off and retrying if the DB is locked. """
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except sqlite3.OperationalError as e:
+                msg = str(e)
+                if "locked" not in msg and "busy" not in msg:
+                    raise
+                if attempt >= self.retries:
+                    raise
+                logging.debug("NeighborTable busy, retrying (%d)" % attempt)
+                time.sleep(self.retry_delay * (2 ** attempt))
+                attempt += 1
+
+    def _write(self, deletes, upserts, updated):
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if deletes:
+                cur.executemany("DELETE FROM NEIGHBOR_TABLE WHERE IPADDRESS=?",
+                                [(ip,) for ip in deletes])
+            if upserts:
+                cur.executemany("INSERT OR REPLACE INTO NEIGHBOR_TABLE "
+                                "(IPADDRESS, UPDATED, HOLDOFF, C0, BSIC) "
+                                "VALUES (?,?,?,?,?)",
+                                [(ip, updated, holdoff, c0, bsic)
+                                 for ip, (c0, bsic, holdoff) in upserts.items()])
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+
+    def sync(self, rows, verify=False):
+        """
+        Make the table match rows ({ip: (c0, bsic)}) for the IPs we manage.
+        If verify is set (or this is the first sync), we read the current
+        rows back first in case OpenBTS rewrote or deleted them.
+
+        Returns:
+            The number of rows we changed. Raises sqlite3.OperationalError if
+            we couldn't get the lock after all our retries.
+        """
+        if verify or not self.loaded:
+            self.load(set(self.expected.keys()) | set(rows.keys()))
+
+        deletes, upserts = self.diff(rows)
+        if len(deletes) == 0 and len(upserts) == 0:
+            return 0
+
+        updated = int(time.time())
+        self._retry(lambda: self._write(deletes, upserts, updated))
+
+        for ip in deletes:
+            del self.expected[ip]
+        self.expected.update(upserts)
+        logging.info("Updated NeighborTable: %d deleted, %d written"
+                     % (len(deletes), len(upserts)))
+        return len(deletes) + len(upserts)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,237 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import re
+import glob
+import shutil
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+
+import gsm
+
+"""
+Offline analysis of GSMTAP captures. Rather than piping a capture through
+GSMWSControl --stdin in real time, we:
+
+    1) Split the capture (or each file in a directory of ring files) into
+       chunks of N packets with editcap.
+    2) Have a pool of processes each run tshark -V on a chunk and walk the
+       output with the same parsing GSMWSControl uses (gsm.py).
+    3) Merge the per-chunk results in capture order.
+
+Measurement reports only make sense with the neighbor list from the last
+System Information Type 2 we saw, and a chunk doesn't know what that was when
+it starts. So workers hold on to any measurement reports that show up before
+their first SI2, and the merge step parses them using the SI2 the previous
+chunk ended with. The GSMTAP header is part of the same packet as the report,
+so the serving ARFCN is always known.
+"""
+
+regex = {'epoch_time': re.compile("Epoch Time: ([\d.]+) seconds")}
+
+class OccupancyStats(object):
+    """
+    Per-ARFCN statistics and a binned time series of mean RXLEV. Reports that
+    list an ARFCN without a reading for it (-0.001 in the decoder) count as
+    "unreported" rather than dragging the mean down.
+    """
+    def __init__(self, bin_seconds=60):
+        self.bin_seconds = bin_seconds
+        self.arfcns = {} # arfcn -> [reports, sum, max, unreported]
+        self.series = {} # arfcn -> {bin start: [count, sum]}
+        self.reports = 0
+
+    def add(self, timestamp, strengths):
+        self.reports += 1
+        for arfcn, rxlev in strengths.items():
+            stat = self.arfcns.setdefault(arfcn, [0, 0, None, 0])
+            if rxlev < 0:
+                stat[3] += 1
+                continue
+            stat[0] += 1
+            stat[1] += rxlev
+            if stat[2] is None or rxlev > stat[2]:
+                stat[2] = rxlev
+            if timestamp is not None:
+                b = int(timestamp // self.bin_seconds) * self.bin_seconds
+                point = self.series.setdefault(arfcn, {}).setdefault(b, [0, 0])
+                point[0] += 1
+                point[1] += rxlev
+
+    def merge(self, other):
+        self.reports += other.reports
+        for arfcn, (n, total, maximum, unreported) in other.arfcns.items():
+            stat = self.arfcns.setdefault(arfcn, [0, 0, None, 0])
+            stat[0] += n
+            stat[1] += total
+            if maximum is not None and (stat[2] is None or maximum > stat[2]):
+                stat[2] = maximum
+            stat[3] += unreported
+        for arfcn, points in other.series.items():
+            mine = self.series.setdefault(arfcn, {})
+            for b, (n, total) in points.items():
+                point = mine.setdefault(b, [0, 0])
+                point[0] += n
+                point[1] += total
+
+    def report(self):
+        arfcns = {}
+        for arfcn, (n, total, maximum, unreported) in sorted(self.arfcns.items()):
+            arfcns[str(arfcn)] = {
+                "reports": n,
+                "unreported": unreported,
+                "mean_rxlev": float(total) / n if n else None,
+                "max_rxlev": maximum,
+                "series": [[b, float(t) / c] for b, (c, t)
+                           in sorted(self.series.get(arfcn, {}).items())]}
+        return {"reports": self.reports, "bin_seconds": self.bin_seconds,
+                "arfcns": arfcns}
+
+def parse_report(last_arfcns, current_arfcn, message):
+    """ Returns the report's strengths, or None if we can't make sense of it. """
+    try:
+        report = gsm.MeasurementReport(last_arfcns, current_arfcn, message)
+    except (AssertionError, IndexError, ValueError):
+        return None
+    if not report.valid:
+        return None
+    return report.current_strengths
+
+class ChunkResult(object):
+    def __init__(self, index, bin_seconds):
+        self.index = index
+        self.stats = OccupancyStats(bin_seconds)
+        self.pending = [] # (timestamp, current arfcn, message) before first SI2
+        self.last_arfcns = None # neighbor list as of the end of the chunk
+        self.current_arfcn = None
+        self.messages = 0
+        self.invalid = 0
+
+def analyze_messages(index, messages, bin_seconds=60):
+    """ Walk one chunk's worth of tshark messages. """
+    result = ChunkResult(index, bin_seconds)
+    timestamp = None
+    for message in messages:
+        result.messages += 1
+        if message.startswith("Frame "):
+            m = regex['epoch_time'].search(message)
+            if m:
+                timestamp = float(m.group(1))
+        elif message.startswith("GSM TAP Header"):
+            try:
+                result.current_arfcn = gsm.GSMTAP(message).arfcn
+            except IndexError:
+                result.invalid += 1
+        elif message.startswith("GSM CCCH - System Information Type 2"):
+            try:
+                result.last_arfcns = gsm.SystemInformationTwo(message).arfcns
+            except IndexError:
+                result.invalid += 1
+        elif message.startswith("GSM A-I/F DTAP - Measurement Report"):
+            if result.current_arfcn is None:
+                result.invalid += 1
+            elif result.last_arfcns is None:
+                result.pending.append((timestamp, result.current_arfcn, message))
+            else:
+                strengths = parse_report(result.last_arfcns, result.current_arfcn, message)
+                if strengths is None:
+                    result.invalid += 1
+                else:
+                    result.stats.add(timestamp, strengths)
+    return result
+
+def analyze_chunk(task):
+    """ Pool worker: run tshark on one chunk file and analyze the output. """
+    index, path, tshark, display_filter, bin_seconds = task
+    cmd = [tshark, "-V", "-n", "-r", path]
+    if display_filter:
+        cmd += ["-Y", display_filter]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        return analyze_messages(index, gsm.messages(proc.stdout), bin_seconds)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+def split_capture(paths, workdir, packets_per_chunk=50000, editcap="editcap"):
+    """
+    Split each capture into chunks of packets_per_chunk packets, in capture
+    order. paths can be files or a directory of ring files (sorted by name,
+    which for dumpcap ring files is capture order).
+
+    Returns:
+        A list of chunk file paths, in capture order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted([f for f in glob.glob(os.path.join(path, "*"))
+                             if os.path.isfile(f)])
+        else:
+            files.append(path)
+
+    chunks = []
+    for n, f in enumerate(files):
+        prefix = os.path.join(workdir, "%06d.pcap" % n)
+        subprocess.check_call([editcap, "-c", str(packets_per_chunk), f, prefix])
+        # editcap names them <prefix base>_00000_<timestamp>.pcap
+        chunks += sorted(glob.glob(os.path.join(workdir, "%06d_*" % n)))
+    return chunks
+
+def merge_results(results, bin_seconds=60):
+    """
+    Merge ChunkResults (in capture order), resolving each chunk's pending
+    reports with the neighbor list the previous chunk ended with.
+    """
+    total = OccupancyStats(bin_seconds)
+    last_arfcns = None
+    summary = {"chunks": 0, "messages": 0, "invalid": 0, "unresolved": 0}
+    for result in results:
+        summary["chunks"] += 1
+        summary["messages"] += result.messages
+        summary["invalid"] += result.invalid
+        for timestamp, current_arfcn, message in result.pending:
+            if last_arfcns is None:
+                summary["unresolved"] += 1
+                continue
+            strengths = parse_report(last_arfcns, current_arfcn, message)
+            if strengths is None:
+                summary["invalid"] += 1
+            else:
+                total.add(timestamp, strengths)
+        total.merge(result.stats)
+        if result.last_arfcns is not None:
+            last_arfcns = result.last_arfcns
+    report = total.report()
+    report.update(summary)
+    return report
+
+def analyze(paths, processes=None, packets_per_chunk=50000, bin_seconds=60,
+            tshark="tshark", editcap="editcap", display_filter=None,
+            workdir=None):
+    """
+    Analyze captures in parallel and return the merged report (a dict ready
+    for json.dump).
+    """
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="gsmws-offline-")
+    try:
+        chunks = split_capture(paths, workdir, packets_per_chunk, editcap)
+        logging.info("Analyzing %d chunks" % len(chunks))
+        tasks = [(i, chunk, tshark, display_filter, bin_seconds)
+                 for i, chunk in enumerate(chunks)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            # imap keeps capture order, so we can merge as results come in
+            return merge_results(pool.imap(analyze_chunk, tasks), bin_seconds)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,181 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import logging
+import threading
+import collections
+
+"""
+Every C0 change means an OpenBTS restart, and every restart drops service for
+15 seconds or more. The controllers used to change C0 far more than they had
+to: Controller picked a new random safe ARFCN every neighbor cycle whether or
+not anything was wrong with the current one, and HandoverController jumped to
+current_arfcn + 10 on every conflict without checking it was any better.
+
+ChangePlanner makes those decisions instead:
+
+    - A BTS keeps its C0 unless something has said it's threatened (see
+      threaten()): a strong report on it from the interference check, a
+      co-channel BSIC, and so on.
+    - A replacement must look safe (RSSI below threshold) and not sit within
+      guard ARFCNs of another unit's C0, or of a channel somebody else is
+      moving to. Among those we prefer fresh observations, wide margins and
+      channels with quiet neighbors, and ones the regional map agrees on.
+    - Only one unit changes at a time (until settle seconds after the last
+      change), so one move can't kick off another right behind it.
+    - Each BTS gets at most one change per min_interval and max_per_day per
+      day. Past that, threats wait.
+
+Threats come in from decoder threads (co-channel sightings) while the
+controller plans on its own, so threats, history and changing are only
+touched holding lock.
+"""
+
+class ChangePlanner(object):
+    def __init__(self, threshold=0, guard=1, stale_after=4*3600, min_interval=900,
+                 max_per_day=12, settle=120):
+        self.threshold = threshold
+        self.guard = guard # keep this many ARFCNs away from other C0s
+        self.stale_after = stale_after # observations older than this are a last resort
+        self.min_interval = min_interval
+        self.max_per_day = max_per_day
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.threats = {} # bts id -> (arfcn, reason, when)
+        self.history = {} # bts id -> deque of change times
+        self.changing = {} # bts id -> (target arfcn, settled at)
+
+    def threaten(self, bts_id, arfcn, reason, now=None):
+        """ Something thinks arfcn, bts_id's C0, is in use by someone else. """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if bts_id not in self.threats:
+                logging.warning("BTS %s: C0 %s threatened (%s)" % (bts_id, arfcn, reason))
+            self.threats[bts_id] = (arfcn, reason, now)
+
+    def threatened(self, bts_id, current):
+        with self.lock:
+            threat = self.threats.get(bts_id)
+            if threat is None:
+                return False
+            if threat[0] != current:
+                # we've already moved off it (and holding the lock, nobody
+                # can have replaced it with a threat to our new C0 meanwhile)
+                del self.threats[bts_id]
+                return False
+            return True
+
+    def allowed(self, bts_id, now):
+        """ Has bts_id got restarts left under the rate limit? """
+        with self.lock:
+            changes = self.history.setdefault(bts_id, collections.deque())
+            while changes and now - changes[0] > 24*3600:
+                changes.popleft()
+            if changes and now - changes[-1] < self.min_interval:
+                return False
+            return len(changes) < self.max_per_day
+
+    def in_flight(self, bts_id, now):
+        """ Another unit's change that hasn't settled yet, as (bts id, target), or None. """
+        with self.lock:
+            for other, (target, until) in self.changing.items():
+                if other != bts_id and now < until:
+                    return other, target
+        return None
+
+    def score(self, arfcn, observations, now):
+        """
+        Higher is better, None if arfcn isn't safe. observations is
+        {arfcn: (rssi, time observed)}.
+        """
+        rssi, observed = observations[arfcn]
+        if rssi >= self.threshold:
+            return None
+        margin = min(self.threshold - rssi, 10.0) / 10.0
+        age = max(0.0, now - observed) / float(self.stale_after)
+        busy_neighbors = 0
+        for adj in (arfcn - 1, arfcn + 1):
+            if adj in observations and observations[adj][0] >= self.threshold:
+                busy_neighbors += 1
+        return margin - age - busy_neighbors
+
+    def choose(self, observations, current=None, reserved=(), regional=None, now=None):
+        """
+        The best replacement for current, or None if nothing will do.
+        reserved are ARFCNs other units are on; regional is the aggregator's
+        safe list (if we have one).
+        """
+        if now is None:
+            now = time.time()
+        reserved = set(reserved)
+        with self.lock:
+            for target, _ in self.changing.values():
+                reserved.add(target)
+        candidates = []
+        for arfcn in observations:
+            if arfcn == current:
+                continue
+            if any(abs(arfcn - r) <= self.guard for r in reserved):
+                continue
+            score = self.score(arfcn, observations, now)
+            if score is None:
+                continue
+            if regional is not None and arfcn not in regional:
+                score -= 1.0
+            candidates.append((score, arfcn))
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+    def plan(self, bts_id, current, observations, reserved=(), regional=None, now=None):
+        """
+        Should bts_id change C0 now, and to what? Returns the new ARFCN, or None
+        to stay put. Nothing's recorded until the caller has actually started
+        the change and tells us with changed().
+        """
+        if now is None:
+            now = time.time()
+        if not self.threatened(bts_id, current):
+            return None
+        other = self.in_flight(bts_id, now)
+        if other is not None:
+            logging.info("BTS %s: waiting for BTS %s to settle on %s before moving"
+                         % (bts_id, other[0], other[1]))
+            return None
+        if not self.allowed(bts_id, now):
+            logging.warning("BTS %s: C0 %s threatened but out of restarts for now"
+                            % (bts_id, current))
+            return None
+        target = self.choose(observations, current, reserved, regional, now)
+        if target is None:
+            logging.error("BTS %s: C0 %s threatened but nowhere safe to go"
+                          % (bts_id, current))
+            return None
+        return target
+
+    def changed(self, bts_id, current, target, now=None):
+        """ bts_id has started moving from current to target (it's restarting). """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            # only the threat we moved for; a new one for target stays
+            threat = self.threats.get(bts_id)
+            reason = "no threat"
+            if threat is not None and threat[0] == current:
+                reason = threat[1]
+                del self.threats[bts_id]
+            self.history.setdefault(bts_id, collections.deque()).append(now)
+            self.changing[bts_id] = (target, now + self.settle)
+        logging.warning("BTS %s: moving C0 %s -> %s (%s)" % (bts_id, current, target, reason))
+
+    def stats(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return {"threats": dict((str(b), {"arfcn": t[0], "reason": t[1]})
+                                    for b, t in self.threats.items()),
+                    "changes_today": dict((str(b), len([c for c in h if now - c <= 24*3600]))
+                                          for b, h in self.history.items())}
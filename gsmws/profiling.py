@@ -0,0 +1,204 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+import collections
+
+"""
+Two kinds of profiling, both safe to leave in a running box:
+
+Timers are always on. Wrap the hot spots (framing, process(), DB flushes,
+set_neighbors) in timers.timed("name") and we keep a count, total and max for
+each; that's a couple of time.time() calls per use.
+
+SamplingProfiler is on demand (SIGUSR1, or profile() through the controller's
+control API, see api.ControlService). For a
+fixed amount of time it samples every thread's stack with
+sys._current_frames(), then writes out:
+
+    profile-<time>.folded   one "thread;frame;frame;... count" line per stack,
+                            which flamegraph.pl and speedscope read directly
+    profile-<time>.txt      the hottest stacks for each thread, for humans
+    profile-<time>.json     the timers, as of the end of the session
+
+Sampling rather than cProfile because cProfile only sees the thread that
+started it, and what we usually want to see is a GSMDecoder thread. When no
+session is running this costs nothing.
+"""
+
+class _Timed(object):
+    __slots__ = ("timers", "name", "start")
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timers.record(self.name, time.time() - self.start)
+        return False
+
+class Timers(object):
+    """ Count, total and max elapsed time for named sections of code. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {} # name -> [count, total, max]
+
+    def timed(self, name):
+        return _Timed(self, name)
+
+    def record(self, name, elapsed):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                self.stats[name] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                if elapsed > stat[2]:
+                    stat[2] = elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, {"count": c, "total": t, "max": m,
+                                "mean": t / c if c else 0.0})
+                        for name, (c, t, m) in self.stats.items())
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+timers = Timers()
+
+def timed(name):
+    """ Decorator version of timers.timed(name). """
+    def wrap(fn):
+        def wrapper(*args, **kwargs):
+            with timers.timed(name):
+                return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return wrap
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of every other thread every interval seconds for
+    duration seconds, then writes the results to outdir.
+    """
+    def __init__(self, duration=30, interval=0.005,
+                 outdir="/var/log/gsmws-profile"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.duration = duration
+        self.interval = interval
+        self.outdir = outdir
+        self.prefix = os.path.join(outdir, time.strftime("profile-%Y%m%d-%H%M%S"))
+        self.counts = collections.defaultdict(int) # (thread, stack) -> samples
+        self.samples = 0
+
+    def _thread_names(self):
+        return dict((t.ident, t.name) for t in threading.enumerate())
+
+    def sample(self):
+        names = self._thread_names()
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.counts[(names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        deadline = time.time() + self.duration
+        logging.warning("Profiling for %ds, writing to %s.*"
+                        % (self.duration, self.prefix))
+        while time.time() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+        try:
+            self.write()
+        except (IOError, OSError) as e:
+            logging.error("Unable to write profile: %s" % e)
+
+    def write(self):
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+        with open(self.prefix + ".folded", "w") as f:
+            for (thread, stack), count in sorted(self.counts.items()):
+                frames = [thread.replace(";", ":")] + [s.replace(";", ":") for s in stack]
+                f.write("%s %d\n" % (";".join(frames), count))
+
+        per_thread = collections.defaultdict(list)
+        for (thread, stack), count in self.counts.items():
+            per_thread[thread].append((count, stack))
+        with open(self.prefix + ".txt", "w") as f:
+            f.write("%d samples every %.3fs\n" % (self.samples, self.interval))
+            for thread in sorted(per_thread):
+                stacks = sorted(per_thread[thread], reverse=True)
+                f.write("\n== %s (%d samples)\n" % (thread, sum([c for c, _ in stacks])))
+                for count, stack in stacks[:10]:
+                    f.write("%6d  %s\n" % (count, " <- ".join(reversed(stack[-5:]))))
+
+        with open(self.prefix + ".json", "w") as f:
+            json.dump(timers.snapshot(), f, indent=2, sort_keys=True)
+        logging.warning("Wrote profile to %s.*" % self.prefix)
+
+_session_lock = threading.Lock()
+_session = [None]
+
+def start_profile(duration=30, interval=0.005, outdir="/var/log/gsmws-profile"):
+    """
+    Start a profiling session unless one's already running.
+
+    Returns:
+        The path prefix the results will be written to, or None if a session
+        was already running.
+    """
+    with _session_lock:
+        if _session[0] is not None and _session[0].is_alive():
+            logging.info("Profile already running")
+            return None
+        profiler = SamplingProfiler(duration, interval, outdir)
+        profiler.start()
+        _session[0] = profiler
+        return profiler.prefix
+
+def install_signal_handler(signum=signal.SIGUSR1, duration=30,
+                           outdir="/var/log/gsmws-profile"):
+    """ Start a profiling session whenever we get signum. Main thread only. """
+    # the handler can run while the main thread holds _session_lock (or the
+    # logging locks), so it only pokes a thread that does the actual starting
+    requested = threading.Event()
+    def starter():
+        while True:
+            requested.wait()
+            requested.clear()
+            start_profile(duration, outdir=outdir)
+    t = threading.Thread(target=starter, name="profile-starter")
+    t.daemon = True
+    t.start()
+    def handler(sig, frame):
+        requested.set()
+    signal.signal(signum, handler)
@@ -0,0 +1,173 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import struct
+import logging
+import threading
+import zmq
+
+"""
+Pushes measurement reports out over a ZMQ PUB socket as the decoder parses
+them, plus a periodic per-ARFCN summary. Unlike polling BTS.reports(), every
+subscriber sees every message, and a slow subscriber can't hold up the decoder:
+once a subscriber is more than hwm messages behind, ZMQ just drops messages
+for it.
+
+Each message is two frames: a topic and a small binary payload. Subscribers
+filter on topic prefix (that's the ZMQ SUBSCRIBE option):
+
+    "report.<bts id>"     one per measurement report
+    "summary.<arfcn>"     one per ARFCN every summary_interval seconds
+
+ARFCNs and BTS ids in topics are zero-padded to 4 digits so that subscribing
+to "summary.0051" doesn't also get you ARFCN 512.
+
+Payloads are little-endian, starting with a version byte:
+
+    report:  version B, bts id H, timestamp d, serving ARFCN H, count H,
+             then count x (ARFCN H, RXLEV b), RXLEV -1 meaning "not reported"
+    summary: version B, bts id H, timestamp d, ARFCN H, samples H,
+             mean RXLEV f, max RXLEV f
+"""
+
+VERSION = 1
+
+REPORT_HEADER = struct.Struct("<BHdHH")
+REPORT_ENTRY = struct.Struct("<Hb")
+SUMMARY = struct.Struct("<BHdHHff")
+
+def report_topic(bts_id):
+    return ("report.%04d" % bts_id).encode('ascii')
+
+def summary_topic(arfcn):
+    return ("summary.%04d" % arfcn).encode('ascii')
+
+def pack_report(bts_id, serving_arfcn, strengths, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    entries = sorted(strengths.items())
+    parts = [REPORT_HEADER.pack(VERSION, bts_id, timestamp,
+                                serving_arfcn or 0, len(entries))]
+    for arfcn, rxlev in entries:
+        # -0.001 is the decoder's "in the neighbor list, but not reported"
+        parts.append(REPORT_ENTRY.pack(arfcn, int(rxlev) if rxlev >= 0 else -1))
+    return b"".join(parts)
+
+def unpack_report(payload):
+    """ Returns a dict with bts_id, timestamp, serving_arfcn, strengths. """
+    version, bts_id, timestamp, serving, count = REPORT_HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError("unknown report version %d" % version)
+    strengths = {}
+    offset = REPORT_HEADER.size
+    for _ in range(count):
+        arfcn, rxlev = REPORT_ENTRY.unpack_from(payload, offset)
+        strengths[arfcn] = rxlev
+        offset += REPORT_ENTRY.size
+    return {"bts_id": bts_id, "timestamp": timestamp,
+            "serving_arfcn": serving, "strengths": strengths}
+
+def pack_summary(bts_id, arfcn, samples, mean, maximum, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return SUMMARY.pack(VERSION, bts_id, timestamp, arfcn,
+                        min(samples, 0xffff), mean, maximum)
+
+def unpack_summary(payload):
+    version, bts_id, timestamp, arfcn, samples, mean, maximum = SUMMARY.unpack(payload)
+    if version != VERSION:
+        raise ValueError("unknown summary version %d" % version)
+    return {"bts_id": bts_id, "timestamp": timestamp, "arfcn": arfcn,
+            "samples": samples, "mean": mean, "max": maximum}
+
+def _set_hwm(sock, opt_name, hwm):
+    # SNDHWM/RCVHWM on ZMQ >= 3, plain HWM before that
+    if hasattr(zmq, opt_name):
+        sock.setsockopt(getattr(zmq, opt_name), hwm)
+    else:
+        sock.setsockopt(zmq.HWM, hwm)
+
+class ReportPublisher(object):
+    """
+    Publishes reports and summaries. Safe to share between decoders.
+    """
+    def __init__(self, endpoint="ipc:///var/run/gsmws-reports", hwm=1000,
+                 summary_interval=10, context=None):
+        self.endpoint = endpoint
+        self.summary_interval = summary_interval
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        _set_hwm(self.socket, "SNDHWM", hwm)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(endpoint)
+
+        self.lock = threading.Lock()
+        self.last_summary = {} # bts id -> time of last summary
+        self.sent = 0
+        self.dropped = 0
+
+    def _send(self, topic, payload):
+        with self.lock:
+            try:
+                self.socket.send_multipart([topic, payload], zmq.NOBLOCK)
+                self.sent += 1
+            except zmq.Again:
+                self.dropped += 1
+
+    def publish_report(self, bts_id, serving_arfcn, strengths):
+        self._send(report_topic(bts_id),
+                   pack_report(bts_id, serving_arfcn, strengths))
+
+    def summary_due(self, bts_id, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last_summary.get(bts_id, 0) >= self.summary_interval
+
+    def publish_summaries(self, bts_id, recent_strengths, max_strengths):
+        """
+        One summary per ARFCN, from the decoder's recent_strengths (a dict of
+        ARFCN -> deque of RXLEV) and max_strengths (ARFCN -> max RXLEV).
+        """
+        now = time.time()
+        self.last_summary[bts_id] = now
+        for arfcn, recent in list(recent_strengths.items()):
+            recent = list(recent)
+            if len(recent) == 0:
+                continue
+            mean = sum(recent) / float(len(recent))
+            maximum = max_strengths.get(arfcn, max(recent))
+            self._send(summary_topic(arfcn),
+                       pack_summary(bts_id, arfcn, len(recent), mean, maximum,
+                                    now))
+        logging.debug("Published summaries for BTS %d (sent=%d dropped=%d)"
+                      % (bts_id, self.sent, self.dropped))
+
+    def close(self):
+        self.socket.close()
+
+class ReportSubscriber(object):
+    """
+    The other end: subscribe to some topic prefixes (default: everything) and
+    get decoded messages back from recv().
+    """
+    def __init__(self, endpoint="ipc:///var/run/gsmws-reports", topics=None,
+                 hwm=1000, context=None):
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        _set_hwm(self.socket, "RCVHWM", hwm)
+        self.socket.connect(endpoint)
+        for topic in (topics or [""]):
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic.encode('ascii'))
+
+    def recv(self, flags=0):
+        """ Returns (topic, message dict). """
+        topic, payload = self.socket.recv_multipart(flags)
+        topic = topic.decode('ascii')
+        if topic.startswith("report."):
+            return topic, unpack_report(payload)
+        return topic, unpack_summary(payload)
+
+    def close(self):
+        self.socket.close()
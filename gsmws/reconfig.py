@@ -0,0 +1,220 @@
+"""
+This file is part of GSMWS.
+"""
+
+import signal
+import logging
+import threading
+import ConfigParser
+
+"""
+Live reconfiguration. Changing the cycle time or the channels we scan used to
+mean restarting the controller, which throws away everything the decoder has
+learned (recent_strengths, max_strengths, last_arfcns), respawns tshark, and
+leaves us without reliable channel data for a good while afterwards.
+
+A Reconfigurator holds the settings the controller is running with. New ones
+come in two ways:
+
+    - SIGHUP, which re-reads the [controller] section of the config file
+      given to watch():
+
+        [controller]
+        cycle = 600
+        min_cycle = 60
+        sleep = 10
+        channels = 1-40, 60, 80-120
+        loglevel = info
+
+    - reconfigure() over XML-RPC (see api.ControlService), with a struct of
+      just the settings to change.
+
+Either way, the new settings are merged into the current ones and validated as
+a whole; anything bad is rejected and nothing changes. Good settings wait in
+pending until the controller's next tick, which takes them all at once (see
+Controller.reconfigure), so a tick never runs with half of one configuration
+and half of another. The decoder, the capture and everything in gsmws.db carry
+on untouched.
+
+Which settings a controller takes is whatever its configuration() returns:
+delta only means something to the HandoverController, for instance.
+"""
+
+LOG_LEVELS = {"debug": logging.DEBUG,
+              "info": logging.INFO,
+              "warning": logging.WARNING,
+              "error": logging.ERROR}
+
+# highest ARFCN we'll scan; 124 is the top of P-GSM 900
+MAX_ARFCN = 124
+
+def parse_channels(value):
+    """ "1-40, 60, 80-120" (or a list of ints) -> sorted list of ARFCNs. """
+    if isinstance(value, (list, tuple)):
+        arfcns = [int(v) for v in value]
+    else:
+        arfcns = []
+        for part in str(value).split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                low, high = [int(p) for p in part.split("-", 1)]
+                if low > high:
+                    raise ValueError("bad channel range %s" % part)
+                arfcns.extend(range(low, high + 1))
+            else:
+                arfcns.append(int(part))
+    return sorted(set(arfcns))
+
+def _positive(settings, name):
+    value = int(settings[name])
+    if value <= 0:
+        raise ValueError("%s must be positive, not %d" % (name, value))
+    settings[name] = value
+
+def validate(settings, min_channels=1):
+    """
+    Check a complete set of settings, and normalize them (ints, a sorted
+    channel list, a lowercase log level). Raises ValueError if they're no good.
+    """
+    settings = dict(settings)
+    try:
+        for name in ("cycle", "min_cycle", "sleep"):
+            if name in settings:
+                _positive(settings, name)
+        if "delta" in settings:
+            settings["delta"] = int(settings["delta"])
+            if settings["delta"] < 0:
+                raise ValueError("delta can't be negative")
+        if "channels" in settings:
+            settings["channels"] = parse_channels(settings["channels"])
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e))
+
+    if "min_cycle" in settings and "cycle" in settings \
+            and settings["min_cycle"] > settings["cycle"]:
+        raise ValueError("min_cycle (%d) is longer than cycle (%d)"
+                         % (settings["min_cycle"], settings["cycle"]))
+    if "sleep" in settings and "cycle" in settings and settings["sleep"] > settings["cycle"]:
+        raise ValueError("sleep (%d) is longer than cycle (%d)"
+                         % (settings["sleep"], settings["cycle"]))
+    if "channels" in settings:
+        channels = settings["channels"]
+        bad = [c for c in channels if c < 1 or c > MAX_ARFCN]
+        if bad:
+            raise ValueError("channels out of range 1-%d: %s" % (MAX_ARFCN, bad))
+        if len(channels) < min_channels:
+            raise ValueError("need at least %d channels to scan, got %d"
+                             % (min_channels, len(channels)))
+    if "loglevel" in settings:
+        level = str(settings["loglevel"]).lower()
+        if level not in LOG_LEVELS:
+            raise ValueError("unknown log level %s (want one of %s)"
+                             % (settings["loglevel"], ", ".join(sorted(LOG_LEVELS))))
+        settings["loglevel"] = level
+    return settings
+
+def read_file(path, section="controller"):
+    """ The settings in [section] of a config file, as strings. """
+    parser = ConfigParser.SafeConfigParser()
+    if not parser.read(path):
+        raise IOError("can't read %s" % path)
+    if not parser.has_section(section):
+        raise ValueError("%s has no [%s] section" % (path, section))
+    return dict(parser.items(section))
+
+class Reconfigurator(object):
+    def __init__(self, current, min_channels=1):
+        self.lock = threading.Lock()
+        self.current = dict(current) # what the controller is running with
+        self.pending = None # validated, waiting for the next tick
+        self.min_channels = min_channels
+        self.path = None
+        self.reload_requested = False # SIGHUP came in
+        self.applied = 0
+        self.rejected = 0
+        self.last_error = None
+
+    def submit(self, changes, source="api"):
+        """
+        Queue changes (a dict of some settings) for the next tick. Returns the
+        complete settings that will be applied; raises ValueError and changes
+        nothing if they don't validate.
+        """
+        with self.lock:
+            unknown = sorted(set(changes) - set(self.current))
+            try:
+                if unknown:
+                    raise ValueError("not settings for this controller: %s"
+                                     % ", ".join(unknown))
+                # on top of anything still pending, so two quick changes both count
+                merged = dict(self.pending or self.current)
+                merged.update(changes)
+                merged = validate(merged, self.min_channels)
+            except ValueError as e:
+                self.rejected += 1
+                self.last_error = str(e)
+                logging.error("Rejected new configuration from %s: %s" % (source, e))
+                raise
+            self.pending = merged
+        logging.warning("New configuration from %s, applying next tick: %s"
+                        % (source, changes))
+        return merged
+
+    def reload(self):
+        """ Re-read the config file given to watch(). """
+        if self.path is None:
+            raise ValueError("no config file to reload")
+        try:
+            changes = read_file(self.path)
+        except (IOError, ConfigParser.Error, ValueError) as e:
+            with self.lock:
+                self.rejected += 1
+                self.last_error = str(e)
+            logging.error("Can't reload %s: %s" % (self.path, e))
+            raise ValueError(str(e))
+        return self.submit(changes, source=self.path)
+
+    def watch(self, path, signum=signal.SIGHUP):
+        """
+        Take settings from path now, and again after every signum. Main thread
+        only. A bad file at startup is an error; a bad file later is logged
+        and ignored, and we carry on with what we had.
+        """
+        self.path = path
+        self.reload()
+        def handler(sig, frame):
+            # the handler can run while the main thread holds our lock, so
+            # leave the actual reading to take()
+            self.reload_requested = True
+        signal.signal(signum, handler)
+
+    def take(self):
+        """ The controller's tick: the settings to apply now, or None. """
+        if self.reload_requested:
+            self.reload_requested = False
+            try:
+                self.reload()
+            except ValueError:
+                pass # already logged
+        with self.lock:
+            pending, self.pending = self.pending, None
+            return pending
+
+    def applied_ok(self, settings):
+        with self.lock:
+            self.current = dict(settings)
+            self.applied += 1
+
+    def configuration(self):
+        with self.lock:
+            return dict(self.current)
+
+    def stats(self):
+        with self.lock:
+            return {"current": dict(self.current),
+                    "pending": self.pending is not None,
+                    "applied": self.applied,
+                    "rejected": self.rejected,
+                    "last_error": self.last_error}
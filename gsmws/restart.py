@@ -0,0 +1,140 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import logging
+import threading
+import envoy
+
+"""
+Restarting OpenBTS takes a while (15s+ before it's actually on the air again),
+and we don't want the controller, or any of the other BTS units it's running,
+to sit and wait for it. A RestartOrchestrator does the restart in its own
+thread:
+
+    1) Mark the BTS as restarting, so its decoder drops whatever reports come
+       in (they're about the old C0, or garbage).
+    2) Run the restart command.
+    3) Probe until OpenBTS is back: NodeManager answers, and the ARFCN we see in
+       GSMTAP headers is the C0 we asked for.
+    4) Resume taking reports, or give up after the timeout.
+"""
+
+class RestartOrchestrator(object):
+    IDLE = "idle"
+    RESTARTING = "restarting"
+    READY = "ready"
+    TIMEOUT = "timeout"
+
+    def __init__(self, bts, timeout=90, probe_interval=1.0):
+        self.bts = bts
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+
+        self.lock = threading.Lock()
+        self.state = RestartOrchestrator.IDLE
+        self.expected_arfcn = None
+        self.started = None
+        self.finished = None
+        self.thread = None
+        self.ignored_before = False # decoder.ignore_reports when we paused it
+        self.done = threading.Event()
+        self.done.set()
+
+    @property
+    def restarting(self):
+        return self.state == RestartOrchestrator.RESTARTING
+
+    def restart(self, expected_arfcn=None):
+        """
+        Kick off a restart in the background. If expected_arfcn is given, we
+        don't consider OpenBTS ready until GSMTAP shows it's using that C0.
+
+        Returns:
+            False if this BTS is already restarting, True otherwise.
+        """
+        with self.lock:
+            if self.restarting:
+                logging.info("Restart already in progress, not restarting again")
+                return False
+            self.state = RestartOrchestrator.RESTARTING
+            self.expected_arfcn = expected_arfcn
+            self.started = time.time()
+            self.finished = None
+            self.done.clear()
+
+        self._pause()
+        self.thread = threading.Thread(target=self._run, args=(expected_arfcn,))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        """ Block until the current restart finishes. Returns the final state. """
+        self.done.wait(timeout)
+        return self.state
+
+    def _pause(self):
+        decoder = self.bts.decoder
+        if decoder is not None:
+            self.ignored_before = decoder.ignore_reports
+            decoder.ignore_reports = True
+            decoder.current_arfcn = None # forget the old C0
+
+    def _resume(self):
+        decoder = self.bts.decoder
+        if decoder is not None:
+            # if something else (a new neighbor list, say) had reports off
+            # before we did, it's still up to that to turn them back on
+            decoder.ignore_reports = self.ignored_before
+
+    def probe(self, expected_arfcn=None):
+        """ Is OpenBTS back up (and on the right C0)? This runs on our own
+        thread, so it relies on the BTS serializing NodeManager calls (see
+        BTS._read_config); the controller leaves NodeManager alone while
+        we're restarting. """
+        try:
+            configured = self.bts.current_arfcn()
+        except Exception as e:
+            logging.debug("NodeManager not answering yet: %s" % e)
+            return False
+        if expected_arfcn is None:
+            return True
+        if configured != expected_arfcn:
+            logging.debug("OpenBTS came back configured for ARFCN %s, "
+                          "expected %s" % (configured, expected_arfcn))
+            return False
+        decoder = self.bts.decoder
+        if decoder is None:
+            return True
+        return decoder.current_arfcn == expected_arfcn
+
+    def _run(self, expected_arfcn):
+        state = RestartOrchestrator.TIMEOUT
+        try:
+            logging.warning("Restarting openbts (expecting ARFCN %s)"
+                            % expected_arfcn)
+            envoy.run(self.bts.restart_cmd)
+            self.bts.restarted()
+
+            deadline = self.started + self.timeout
+            while time.time() < deadline:
+                if self.probe(expected_arfcn):
+                    state = RestartOrchestrator.READY
+                    break
+                time.sleep(self.probe_interval)
+        except Exception as e:
+            logging.error("Restart failed: %s" % e)
+        finally:
+            self.finished = time.time()
+            if state == RestartOrchestrator.READY:
+                logging.warning("OpenBTS ready after %.1fs"
+                                % (self.finished - self.started))
+            else:
+                logging.error("OpenBTS not ready after %ds, resuming anyway"
+                              % self.timeout)
+            self._resume()
+            with self.lock:
+                self.state = state
+            self.done.set()
@@ -0,0 +1,193 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import array
+import threading
+
+"""
+ReportRing is a fixed-size ring buffer of measurement report entries, stored
+as preallocated typed columns (the array module, so no NumPy needed):
+
+    ts      'd'  when the decoder parsed the report (time.time())
+    bts     'H'  which BTS/decoder it came from
+    arfcn   'H'  neighbor ARFCN
+    rxlev   'f'  RXLEV for that ARFCN (-0.001 if listed but not reported)
+    report  'L'  report number, so we can put the entries back together
+    offset  'I'  row within its report; 0 is the first
+
+One report is one row per ARFCN in it. There's exactly one writer (the
+decoder), which fills in rows and then bumps seq, the total number of rows
+ever written. Readers each keep a Cursor -- the seq they've read up to -- so
+the controller, the interference detector and the API server all see every
+report without taking them away from each other, and nothing ever grows past
+capacity rows. A reader that falls more than capacity rows behind skips ahead
+to the oldest row still around and counts what it missed in lapped.
+
+Readers don't lock: they read seq, copy out the rows they want, then check
+(against head, which the writer bumps before it starts overwriting anything)
+that the writer didn't lap them while they were copying. A reader that was
+lapped (or a new cursor, which starts at the oldest row) may begin partway
+through a report whose first rows are gone; it drops just those rows, and
+starts from the first report it has all of.
+"""
+
+class Batch(object):
+    """ Some rows copied out of a ReportRing, column by column. """
+    def __init__(self, ts, bts, arfcn, rxlev, report, offset, start, end):
+        self.ts = ts
+        self.bts = bts
+        self.arfcn = arfcn
+        self.rxlev = rxlev
+        self.report = report
+        self.offset = offset
+        self.start = start # seq of the first row
+        self.end = end # seq just past the last row
+
+    def __len__(self):
+        return len(self.ts)
+
+    def reports(self):
+        """ Group rows back into [(timestamp, bts, {arfcn: rxlev})], oldest first. """
+        res = []
+        last = None
+        for i in range(len(self.ts)):
+            if self.report[i] != last:
+                last = self.report[i]
+                entry = {}
+                res.append((self.ts[i], self.bts[i], entry))
+            entry[self.arfcn[i]] = self.rxlev[i]
+        return res
+
+class Cursor(object):
+    """ One reader's position in a ReportRing. """
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+        self.lapped = 0 # rows we never got to see
+
+    def pending(self):
+        return self.ring.seq - self.position
+
+    def read(self, limit=None):
+        """ Returns a Batch of (up to limit) rows we haven't read yet. """
+        batch = self.ring.read(self.position, limit)
+        self.lapped += batch.start - self.position
+        self.position = batch.end
+        return batch
+
+    def reports(self, limit=None):
+        """ Like read(), but as [{arfcn: rxlev}], like the old MeasurementReportList. """
+        return [strengths for _, _, strengths in self.read(limit).reports()]
+
+class ReportRing(object):
+    COLUMNS = [("ts", "d"), ("bts", "H"), ("arfcn", "H"), ("rxlev", "f"), ("report", "L"),
+               ("offset", "I")]
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        for name, typecode in ReportRing.COLUMNS:
+            setattr(self, name, array.array(typecode, [0]) * capacity)
+        self.seq = 0 # rows written, ever
+        self.head = 0 # rows the writer has started on (>= seq)
+        self.report_seq = 0 # reports written, ever
+        self.cursors = {}
+        self.cursor_lock = threading.Lock()
+
+    def put(self, strengths, bts=0, timestamp=None):
+        """
+        Append one report ({arfcn: rxlev}). Writer only: there must be just one
+        thread calling this.
+        """
+        if len(strengths) > self.capacity:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        i = self.seq
+        report = self.report_seq % 0xffffffff
+        # tell readers which rows we're about to overwrite
+        self.head = i + len(strengths)
+        for offset, (arfcn, rxlev) in enumerate(strengths.items()):
+            j = i % self.capacity
+            self.ts[j] = timestamp
+            self.bts[j] = bts
+            self.arfcn[j] = arfcn
+            self.rxlev[j] = rxlev
+            self.report[j] = report
+            self.offset[j] = offset
+            i += 1
+        # publish the rows only once they're all written
+        self.report_seq += 1
+        self.seq = i
+
+    def oldest(self):
+        return max(0, self.seq - self.capacity)
+
+    def _copy(self, start, end):
+        a, b = start % self.capacity, end % self.capacity
+        cols = []
+        for name, _ in ReportRing.COLUMNS:
+            col = getattr(self, name)
+            if end - start == 0:
+                cols.append(col[0:0])
+            elif a < b:
+                cols.append(col[a:b])
+            else: # wraps around
+                cols.append(col[a:] + col[:b])
+        return cols
+
+    def _boundary(self, start, end, seq):
+        # don't split a report across batches: back end up to where a report
+        # starts, or go forward if a single report is bigger than the batch
+        report = self.report
+        cut = end
+        while cut > start and report[cut % self.capacity] == report[(cut - 1) % self.capacity]:
+            cut -= 1
+        if cut > start:
+            return cut
+        while end < seq and report[end % self.capacity] == report[(end - 1) % self.capacity]:
+            end += 1
+        return end
+
+    def read(self, position, limit=None):
+        """ Copy out rows from seq position onward. See Cursor. """
+        end = self.seq
+        start = max(position, end - self.capacity)
+        if limit is not None and start + limit < end:
+            end = self._boundary(start, start + limit, end)
+        cols = self._copy(start, end)
+        # did the writer overwrite any of that while we were copying?
+        lost = max(0, min(self.head - self.capacity - start, end - start))
+        if lost == end - start and end > start:
+            # lost the lot (and end may not be on a report boundary any more);
+            # stay put and catch up from the oldest row next time
+            empty = [c[0:0] for c in cols]
+            return Batch(*(empty + [position, position]))
+        # if we're starting partway through a report (lapped, or a new
+        # cursor), its first rows are gone; resume at the next one that starts
+        offset = cols[-1]
+        while lost < end - start and offset[lost] != 0:
+            lost += 1
+        if lost:
+            cols = [c[lost:] for c in cols]
+            start += lost
+        return Batch(*(cols + [start, end]))
+
+    def cursor(self, name=None):
+        """
+        Returns the cursor called name, starting at the oldest row still in the
+        ring if it's new. Without a name, a new private cursor.
+        """
+        if name is None:
+            return Cursor(self, self.oldest())
+        with self.cursor_lock:
+            if name not in self.cursors:
+                self.cursors[name] = Cursor(self, self.oldest())
+            return self.cursors[name]
+
+    def stats(self):
+        return {"capacity": self.capacity, "seq": self.seq,
+                "reports": self.report_seq,
+                "cursors": dict((name, {"pending": c.pending(), "lapped": c.lapped})
+                                for name, c in self.cursors.items())}
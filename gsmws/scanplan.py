@@ -0,0 +1,146 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import logging
+
+"""
+Cooperative scanning for the HandoverController. Each BTS unit used to pick
+its own neighbors to scan (and in practice got a hardcoded [30, 40] or
+[20, 40]), so units spent their cycles listening to the same channels, and
+adding a unit didn't get the band scanned any faster.
+
+ScanPlanner splits the band between the units instead. When a unit's cycle is
+up, it asks assign() for its next share: the channels nobody else is holding
+right now, those we've never scanned first, then the ones scanned longest ago.
+A channel counts as scanned once the unit holding it has got min_reports
+reports in while it was listed; until then it goes back in the pool. Units
+keep their staggered cycles, and since no two hold the same channel, N units
+get through the band about N times as fast as one.
+
+A unit that's restarting, or that's gone quiet_after seconds without a single
+report (no phones camped on it, so it can't tell us anything), gets no share:
+whatever it was holding is released straight away, uncredited, for the next
+working unit to pick up, and it gets new channels once reports start coming
+in again.
+"""
+
+class ScanPlanner(object):
+    def __init__(self, channels, per_unit=5, stale_after=4*3600, quiet_after=300,
+                 min_reports=10):
+        self.channels = list(channels)
+        self.per_unit = per_unit # channels per unit per cycle
+        self.stale_after = stale_after # rescan channels scanned longer ago than this
+        self.quiet_after = quiet_after
+        self.min_reports = min_reports
+        self.last_scanned = {} # arfcn -> when it was last credited
+        self.holding = {} # unit -> (arfcns, report count at start, when)
+        self.progress = {} # unit -> (report count, when it last went up)
+        self.restarting = set()
+        self.reserved = set() # our own C0s, which nobody scans
+        self.sweep_started = time.time()
+        self.sweeps = 0
+        self.last_sweep = None # seconds the last full sweep took
+
+    def update(self, unit, restarting, reports, now=None):
+        """
+        Every tick, for every unit: whether it's restarting, and how many
+        reports its decoder has ever seen (ReportRing.report_seq).
+        """
+        if now is None:
+            now = time.time()
+        last = self.progress.get(unit)
+        if last is None or reports != last[0]:
+            self.progress[unit] = (reports, now)
+        if restarting:
+            self.restarting.add(unit)
+        else:
+            self.restarting.discard(unit)
+        if unit in self.holding and not self.active(unit, now):
+            logging.info("Unit %s is %s, handing back %s" % (unit,
+                         "restarting" if restarting else "quiet",
+                         sorted(self.holding[unit][0])))
+            del self.holding[unit]
+
+    def active(self, unit, now=None):
+        """ Can unit tell us anything about the channels we give it? """
+        if unit in self.restarting:
+            return False
+        if now is None:
+            now = time.time()
+        last = self.progress.get(unit)
+        return last is not None and now - last[1] <= self.quiet_after
+
+    def release(self, unit, now=None):
+        """ unit's cycle is over: credit what it held, if it got reports in. """
+        if now is None:
+            now = time.time()
+        held = self.holding.pop(unit, None)
+        if held is None:
+            return
+        arfcns, start, _ = held
+        reports = self.progress.get(unit, (start, now))[0]
+        if reports - start < self.min_reports:
+            logging.info("Unit %s only got %d reports, not crediting %s"
+                         % (unit, reports - start, sorted(arfcns)))
+            return
+        for arfcn in arfcns:
+            self.last_scanned[arfcn] = now
+        self._check_sweep(now)
+
+    def _check_sweep(self, now):
+        if all(c in self.last_scanned and self.last_scanned[c] >= self.sweep_started
+               for c in self.channels if c not in self.reserved):
+            self.sweeps += 1
+            self.last_sweep = now - self.sweep_started
+            logging.info("Scanned the whole band in %.0fs" % self.last_sweep)
+            self.sweep_started = now
+
+    def held(self, but=None):
+        res = set()
+        for unit, (arfcns, _, _) in self.holding.items():
+            if unit != but:
+                res |= arfcns
+        return res
+
+    def assign(self, unit, reserved=(), now=None):
+        """
+        unit's cycle is up. Credits its last share, and returns its next one
+        (a list of ARFCNs, maybe empty). reserved are channels not to hand out,
+        like our own C0s.
+        """
+        if now is None:
+            now = time.time()
+        self.release(unit, now)
+        if not self.active(unit, now):
+            return []
+        self.reserved = set(reserved)
+        taken = self.held(but=unit) | self.reserved
+        candidates = [c for c in self.channels if c not in taken]
+        # never scanned (0), then oldest; fresh ones only if there's nothing else
+        candidates.sort(key=lambda c: self.last_scanned.get(c, 0))
+        stale = [c for c in candidates if now - self.last_scanned.get(c, 0) > self.stale_after]
+        share = (stale or candidates)[:self.per_unit]
+        self.holding[unit] = (set(share), self.progress[unit][0], now)
+        return share
+
+    def coverage(self, now=None):
+        """ Fraction of the band scanned within stale_after. """
+        if now is None:
+            now = time.time()
+        channels = [c for c in self.channels if c not in self.reserved]
+        if not channels:
+            return 0.0
+        fresh = [c for c in channels
+                 if now - self.last_scanned.get(c, 0) <= self.stale_after]
+        return len(fresh) / float(len(channels))
+
+    def stats(self, now=None):
+        if now is None:
+            now = time.time()
+        return {"coverage": self.coverage(now),
+                "sweeps": self.sweeps,
+                "last_sweep": self.last_sweep,
+                "holding": dict((str(u), sorted(h[0])) for u, h in self.holding.items()),
+                "active": sorted([str(u) for u in self.progress if self.active(u, now)])}
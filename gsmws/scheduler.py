@@ -0,0 +1,207 @@
+"""
+This file is part of GSMWS.
+"""
+
+import time
+import logging
+import threading
+
+import profiling
+
+"""
+The controller's main loop used to do everything in one go -- dwell, C0
+checks, set_neighbors, rssi(), update_rssi_db, safe_arfcns() -- and then sleep
+SLEEP_TIME. So one slow NodeManager call or SQLite flush pushed back every
+deadline after it, and the real period drifted well past the configured one.
+
+TickScheduler runs periodic tasks against deadlines on a monotonic clock
+instead. Each task has:
+
+    period    seconds between runs. The next deadline is the last one plus
+              period, not "period after we finished", so slow runs don't
+              accumulate. A run that starts a bit late keeps the deadline
+              after it. If we fall a whole period or more behind, we don't
+              try to catch up with a burst of runs; we count the deadlines
+              we skipped as missed and run once, for the latest of them.
+    priority  HIGH, NORMAL or LOW. Due tasks run most important first.
+    budget    how long a run should take. Going over counts as an overrun.
+
+A tick that has already used tick_budget seconds skips the LOW tasks (saving
+to the DB, diagnostic logging) that are due, and they wait for their next
+period. So they don't starve, a LOW task that has been put off for max_defer
+of its periods runs anyway.
+
+Per task we keep runs, skips, overruns and lateness (how long after its
+deadline it started); stats() has them all. Elapsed times also go to the
+profiling timers as <name>.<task>.
+"""
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+def _clock_gettime():
+    """ CLOCK_MONOTONIC through ctypes, for pythons without time.monotonic. """
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    libname = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+    lib = ctypes.CDLL(libname, use_errno=True)
+    clock_gettime = lib.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1 # linux
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
+    monotonic() # make sure it works before we rely on it
+    return monotonic
+
+def _pick_clock():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        return _clock_gettime()
+    except Exception as e:
+        logging.warning("No monotonic clock (%s), using time.time" % e)
+        return time.time
+
+monotonic = _pick_clock()
+
+class Task(object):
+    def __init__(self, name, fn, period, priority=NORMAL, budget=None):
+        self.name = name
+        self.fn = fn
+        self.period = period
+        self.priority = priority
+        self.budget = budget
+        self.due = None # next deadline, on the scheduler's clock
+        self.runs = 0
+        self.skips = 0
+        self.missed = 0 # periods we fell behind by and didn't run at all
+        self.overruns = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+        self.elapsed_max = 0.0
+        self.deferred_since = None
+
+    def stats(self):
+        return {"period": self.period,
+                "priority": self.priority,
+                "budget": self.budget,
+                "runs": self.runs,
+                "skips": self.skips,
+                "missed": self.missed,
+                "overruns": self.overruns,
+                "late_max": self.late_max,
+                "late_mean": self.late_total / self.runs if self.runs else 0.0,
+                "elapsed_max": self.elapsed_max}
+
+class TickScheduler(object):
+    def __init__(self, tick_budget=None, max_defer=4, stopped=None, clock=None,
+                 name="scheduler"):
+        self.tick_budget = tick_budget # None: never skip LOW tasks
+        self.max_defer = max_defer
+        self.stopped = stopped if stopped is not None else threading.Event()
+        self.clock = clock or monotonic
+        self.name = name
+        self.tasks = []
+        self.ticks = 0
+        self.overrun_ticks = 0
+
+    def add(self, name, fn, period, priority=NORMAL, budget=None, start=None):
+        """
+        Run fn() every period seconds, first at start (on our clock; default:
+        the next tick).
+        """
+        task = Task(name, fn, period, priority, budget)
+        task.due = start if start is not None else self.clock()
+        self.tasks.append(task)
+        return task
+
+    def task(self, name):
+        for t in self.tasks:
+            if t.name == name:
+                return t
+        raise KeyError(name)
+
+    def set_period(self, name, period):
+        """ Takes effect from the task's next deadline. """
+        self.task(name).period = period
+
+    def _reschedule(self, task, now):
+        task.due += task.period
+        if now - task.due >= task.period:
+            # skip the deadlines a whole period or more gone; the latest one
+            # still runs (late), and we stay in phase
+            behind = int((now - task.due) // task.period)
+            task.missed += behind
+            task.due += behind * task.period
+
+    def tick(self):
+        """ Run whatever's due now, most important first. """
+        start = self.clock()
+        due = sorted([t for t in self.tasks if t.due <= start],
+                     key=lambda t: (t.priority, t.due))
+        overran = False
+        for task in due:
+            now = self.clock()
+            if (task.priority == LOW and self.tick_budget is not None
+                    and now - start > self.tick_budget):
+                if task.deferred_since is None:
+                    task.deferred_since = task.due
+                if now - task.deferred_since < self.max_defer * task.period:
+                    task.skips += 1
+                    overran = True
+                    self._reschedule(task, now)
+                    continue
+                logging.warning("%s: running %s anyway after deferring it %.1fs"
+                                % (self.name, task.name, now - task.deferred_since))
+            task.deferred_since = None
+
+            late = max(0.0, now - task.due)
+            try:
+                task.fn()
+            finally:
+                elapsed = self.clock() - now
+                task.runs += 1
+                task.late_total += late
+                task.late_max = max(task.late_max, late)
+                task.elapsed_max = max(task.elapsed_max, elapsed)
+                if task.budget is not None and elapsed > task.budget:
+                    task.overruns += 1
+                    logging.warning("%s: %s took %.2fs (budget %.2fs)"
+                                    % (self.name, task.name, elapsed, task.budget))
+                profiling.timers.record("%s.%s" % (self.name, task.name), elapsed)
+                self._reschedule(task, self.clock())
+        self.ticks += 1
+        elapsed = self.clock() - start
+        if overran or (self.tick_budget is not None and elapsed > self.tick_budget):
+            self.overrun_ticks += 1
+        profiling.timers.record("%s.tick" % self.name, elapsed)
+
+    def next_due(self):
+        return min([t.due for t in self.tasks]) if self.tasks else None
+
+    def run(self):
+        """ Tick until stopped is set (or ^C). """
+        while not self.stopped.is_set():
+            try:
+                self.tick()
+                if not self.tasks:
+                    break
+                wait = self.next_due() - self.clock()
+                if wait > 0:
+                    self.stopped.wait(wait)
+            except KeyboardInterrupt:
+                break
+
+    def stats(self):
+        return {"ticks": self.ticks,
+                "overrun_ticks": self.overrun_ticks,
+                "tasks": dict((t.name, t.stats()) for t in self.tasks)}
@@ -0,0 +1,254 @@
+"""
+This file is part of GSMWS.
+"""
+
+import os
+import gc
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import traceback
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # python 2, unless pytracemalloc is installed
+
+import controller
+import fakes
+
+"""
+Soak test. Our boxes run for months, and a few structures grow with whatever
+we happen to see. This runs a real Controller and GSMDecoder against a
+FakeBTS and a synthetic report stream, speeded up by some multiple of the
+field rate (report rate, and the controller's timers with it). Every interval
+it samples:
+
+    - resident memory (VmRSS from /proc, or peak RSS from getrusage)
+    - tracemalloc's total and top allocation sites, when tracemalloc exists
+    - the sizes of the structures we know can grow (see structure_sizes)
+
+At the end, each series gets a growth check. Structures with a hard cap
+(see structure_caps) fail if they ever go over it: the parse cache, say,
+takes a good few minutes of field time to fill, and a short run catches it
+still filling. The caps are what this run can actually put in them (for the
+per-ARFCN ones, the channels we scan plus our C0s), not what they could hold
+in theory. Everything else: skip the first quarter (warmup), split what's
+left in two, and say it grew if the later half's peak and mean are both
+meaningfully above the earlier half's. Things that are bounded level off, so
+the later half isn't any higher; leaks keep climbing.
+
+Results are a dict ready for json.dump, with "passed" at the top.
+"""
+
+def rss_kb():
+    """ Resident set size of this process in kB. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource # peak rather than current, but it's what we've got
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def structure_sizes(c):
+    """ Sizes of the things in a running Controller that could grow. """
+    d = c.bts.decoder
+    recent = list(d.recent_strengths.values())
+    return {"controller.c0s_to_scan": len(c.c0s_to_scan),
+            "controller.planner.history": sum([len(h) for h in list(c.planner.history.values())]),
+            "decoder.max_strengths": len(d.max_strengths),
+            "decoder.recent_strengths": len(recent),
+            "decoder.recent_strengths.values": sum([len(r) for r in recent]),
+            "decoder.rssi_queue": d.rssi_queue.qsize(),
+            "decoder.parse_cache": len(d.parse_cache.entries),
+            "decoder.report_cursors": len(d.reports.cursors),
+            "decoder.cochannel.sightings": sum([len(s) for s in list(d.cochannel.sightings.values())]),
+            "decoder.neighbor_listeners": len(d.neighbor_listeners),
+            "threads": threading.active_count(),
+            "gc.objects": len(gc.get_objects())}
+
+def structure_caps(c, rate, c0s=()):
+    """
+    The most each of the capped structure_sizes can ever hold, with reports
+    coming in at rate a second and the BTS having been on c0s.
+    """
+    d = c.bts.decoder
+    # keyed on what reports name: the neighbors we set (from CHANNELS) and
+    # our own C0s, nothing else
+    arfcns = len(set(c.CHANNELS) | set(c0s))
+    # a report has at most 6 neighbor BSICs, and a sighting lasts until a
+    # window has passed since the last one for its (ARFCN, BSIC)
+    sightings = 6 * int(rate * 2 * d.cochannel.window)
+    return {"controller.c0s_to_scan": len(c.CHANNELS),
+            "decoder.cochannel.sightings": sightings,
+            "decoder.max_strengths": arfcns,
+            "decoder.recent_strengths": arfcns,
+            "decoder.recent_strengths.values": arfcns * d.strengths_maxlen,
+            "decoder.parse_cache": d.parse_cache.maxsize}
+
+def grew(values, tolerance=0.1, slack=2):
+    """ Does this series look like it's still climbing? See module docs. """
+    values = values[len(values) // 4:]
+    if len(values) < 4:
+        return False
+    half = len(values) // 2
+    before, after = values[:half], values[half:]
+    def higher(a, b):
+        return a > b * (1 + tolerance) + slack
+    # both, so a one-off spike (a queue that hasn't been flushed yet) doesn't count
+    return (higher(max(after), max(before))
+            and higher(sum(after) / float(len(after)), sum(before) / float(len(before))))
+
+class Soak(object):
+    def __init__(self, duration=600, multiplier=20, interval=5, field_rate=2.0,
+                 busy=(3, 40, 77), workdir=None, top=10):
+        self.duration = duration
+        self.multiplier = multiplier
+        self.interval = interval
+        self.rate = field_rate * multiplier
+        self.busy = busy
+        self.workdir = workdir
+        self.top = top
+        self.samples = []
+        self.stopped = threading.Event()
+        self.first_snapshot = None
+        self.error = None # traceback, if the controller died
+        self.scheduler = None # the controller's scheduler stats, at the end
+        self.caps = {}
+        self.c0s = set() # every C0 the BTS has been on
+
+    def _controller(self, workdir):
+        # the usual defaults (600s cycle, 60s minimum, 10s ticks), speeded up
+        m = float(self.multiplier)
+        return controller.Controller(None, None, None, 600 / m, 10 / m,
+                                     os.path.join(workdir, "gsmws.db"),
+                                     loglvl=logging.WARNING, bts_class=fakes.FakeBTS,
+                                     min_cycle=60 / m)
+
+    def sample(self, c, start):
+        point = {"t": time.time() - start, "rss_kb": rss_kb()}
+        for _ in range(3):
+            try:
+                point["structures"] = structure_sizes(c)
+                self.c0s.add(c.bts.current_arfcn())
+                self.caps = structure_caps(c, self.rate, self.c0s)
+                break
+            except RuntimeError:
+                continue # something changed size under us; try again
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            point["tracemalloc_kb"] = sum([s.size for s in snapshot.statistics("filename")]) // 1024
+            if self.first_snapshot is None and point["t"] >= self.duration / 4.0:
+                self.first_snapshot = snapshot # after warmup
+            self.last_snapshot = snapshot
+        self.samples.append(point)
+
+    def _sampler(self, c, start):
+        # wait for main() to get the BTS and decoder going
+        while c.bts is None or c.bts.decoder is None:
+            if self.stopped.wait(0.1):
+                return
+        while not self.stopped.wait(self.interval):
+            self.sample(c, start)
+            if time.time() - start >= self.duration:
+                break
+        c.stop()
+
+    def run(self):
+        workdir = self.workdir or tempfile.mkdtemp(prefix="gsmws-soak-")
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        stream_stopped = threading.Event()
+        c = None
+        try:
+            c = self._controller(workdir)
+            sampler = threading.Thread(target=self._sampler, args=(c, start))
+            sampler.daemon = True
+            sampler.start()
+            # main() has to be on this thread: it owns the controller's sqlite
+            # connection. The sampler stops it when time's up.
+            try:
+                c.main(stream=_LazyStream(c, self.rate, self.busy, stream_stopped))
+            except Exception:
+                self.error = traceback.format_exc()
+                logging.error("Controller died: %s" % self.error)
+            self.stopped.set()
+            sampler.join()
+            if c.scheduler is not None:
+                self.scheduler = c.scheduler.stats()
+        finally:
+            # the decoder runs until its stream ends
+            stream_stopped.set()
+            self.stopped.set()
+            if c is not None and c.bts is not None and c.bts.decoder is not None:
+                c.bts.decoder.join(10)
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            if self.workdir is None:
+                shutil.rmtree(workdir, ignore_errors=True)
+        return self.results(time.time() - start)
+
+    def results(self, elapsed):
+        series = {"rss_kb": [s["rss_kb"] for s in self.samples]}
+        if self.samples and "tracemalloc_kb" in self.samples[0]:
+            series["tracemalloc_kb"] = [s.get("tracemalloc_kb", 0) for s in self.samples]
+        for name in self.samples[0].get("structures", {}) if self.samples else []:
+            series[name] = [s.get("structures", {}).get(name, 0) for s in self.samples]
+
+        growth = {}
+        for name, values in series.items():
+            if name.endswith("_kb"):
+                # allocator noise: allow 10% plus 4MB
+                g = grew(values, 0.1, 4096)
+            elif name == "gc.objects":
+                g = grew(values, 0.05, 1000)
+            elif name in self.caps:
+                g = bool(values) and max(values) > self.caps[name]
+            else:
+                g = grew(values)
+            growth[name] = {"first": values[0] if values else None,
+                            "cap": self.caps.get(name),
+                            "last": values[-1] if values else None,
+                            "peak": max(values) if values else None,
+                            "grew": g}
+
+        top = []
+        if self.first_snapshot is not None:
+            for stat in self.last_snapshot.compare_to(self.first_snapshot, "lineno")[:self.top]:
+                top.append({"where": str(stat.traceback), "size_diff_kb": stat.size_diff // 1024,
+                            "count_diff": stat.count_diff})
+
+        return {"passed": (self.error is None and len(self.samples) >= 4
+                           and not any(g["grew"] for g in growth.values())),
+                "error": self.error,
+                "duration": elapsed,
+                "multiplier": self.multiplier,
+                "report_rate": self.rate,
+                "tracemalloc": tracemalloc is not None,
+                "growth": growth,
+                "top_allocations": top,
+                "scheduler": self.scheduler,
+                "samples": self.samples}
+
+class _LazyStream(object):
+    """
+    Controller.main() makes the BTS itself, so we can't build the synthetic
+    stream (which reads the BTS's neighbors) until it has.
+    """
+    def __init__(self, c, rate, busy, stopped):
+        self.c = c
+        self.rate = rate
+        self.busy = busy
+        self.stopped = stopped
+
+    def __iter__(self):
+        while self.c.bts is None:
+            time.sleep(0.01)
+        return fakes.synthetic_stream(self.c.bts, self.rate, self.busy,
+                                      stopped=self.stopped)
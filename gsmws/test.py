@@ -1,9 +1,148 @@
-__author__ = 'root'
+"""
+This file is part of GSMWS.
 
+Tests for the pieces we can check without a radio, against the stand-ins in
+fakes.py. Run them from this directory:
 
+    python -m unittest test
+"""
 
-def main():
-    last_arfcns = [12, 22, 32, 33]
-    strengths = dict(zip(last_arfcns, [-0.001 for _ in range(0, len(last_arfcns))]))
+import os
+import shutil
+import random
+import tempfile
+import threading
+import unittest
 
-    print(strengths)
\ No newline at end of file
+import cmdsocket
+import fakes
+import ringbuffer
+
+class CommandSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="gsmws-test-")
+        self.path = os.path.join(self.dir, "command")
+        self.server = fakes.FakeCommandServer(self.path,
+                                              handler=lambda c: "reply to %s" % c)
+        self.server.start()
+        self.cli = cmdsocket.CommandSocket(self.path, timeout=2.0, retries=0,
+                                           local_dir=self.dir)
+
+    def tearDown(self):
+        self.cli.close()
+        self.server.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        self.assertEqual(self.cli.command("txatten 10"), "reply to txatten 10")
+        self.assertEqual(self.cli.command("txatten 20"), "reply to txatten 20")
+        self.assertEqual(self.server.commands, ["txatten 10", "txatten 20"])
+        self.assertEqual(self.cli.connects, 1) # the socket is kept around
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        self.cli.timeout = 0.1
+        self.assertRaises(cmdsocket.CommandTimeout, self.cli.send, "slow")
+        self.assertTrue(self.cli.sock is None)
+
+    def test_reconnect_after_timeout(self):
+        self.server.delay = 0.5
+        self.cli.timeout = 0.1
+        self.assertRaises(cmdsocket.CommandTimeout, self.cli.send, "slow")
+
+        # the server answers "slow" late, to the socket we threw away, and
+        # then answers us on the new one
+        self.server.delay = 0
+        self.cli.timeout = 2.0
+        self.assertEqual(self.cli.send("fast"), "reply to fast")
+        self.assertEqual(self.cli.connects, 2)
+
+    def test_drain_late_reply(self):
+        self.cli.connect()
+        # a reply to something we've already given up on, sitting in our queue
+        # (it has to come from the server: our socket is connected to it)
+        self.server.sock.sendto(b"reply to something else\0", self.cli.local_path)
+        self.assertEqual(self.cli.send("fresh"), "reply to fresh")
+        self.assertEqual(self.cli.connects, 1)
+
+    def test_check_response(self):
+        self.assertEqual(cmdsocket.check_response("TRX.TxAttenOffset 10"),
+                         "TRX.TxAttenOffset 10")
+        for msg in cmdsocket.failure_messages:
+            self.server.handler = lambda c, msg=msg: "%s: %s" % (c, msg)
+            self.assertRaises(cmdsocket.CommandError, self.cli.command, "bad")
+            # a CommandError is a ValueError, which is what callers catch
+            self.assertRaises(ValueError, cmdsocket.check_response, msg)
+
+def numbered_report(n):
+    """ Report n: 1 to 5 rows, every rxlev n, so we can tell if it's torn. """
+    return dict((n * 5 % 60000 + k, float(n)) for k in range(1 + n % 5))
+
+class ReportRingTest(unittest.TestCase):
+    def check_complete(self, reports):
+        """ Every report whole, in order; returns their numbers. """
+        numbers = []
+        for r in reports:
+            n = int(list(r.values())[0])
+            self.assertEqual(r, numbered_report(n))
+            numbers.append(n)
+        self.assertEqual(numbers, sorted(set(numbers)))
+        return numbers
+
+    def test_read(self):
+        ring = ringbuffer.ReportRing(100)
+        cursor = ring.cursor("test")
+        for n in range(10):
+            ring.put(numbered_report(n))
+        self.assertEqual(self.check_complete(cursor.reports()), list(range(10)))
+        self.assertEqual(cursor.reports(), [])
+        self.assertEqual(cursor.lapped, 0)
+
+    def test_lapped(self):
+        ring = ringbuffer.ReportRing(10)
+        cursor = ring.cursor("test")
+        for _ in range(5):
+            ring.put({1: 1.0, 2: 2.0, 3: 3.0, 4: 4.0}) # 20 rows
+        # rows 10-19 are left: reports 2 (rows 8-11, half gone) to 4. We get
+        # the two whole ones and skip what we missed.
+        self.assertEqual(len(cursor.reports()), 2)
+        self.assertEqual(cursor.lapped, 12)
+        self.assertEqual(cursor.pending(), 0)
+
+    def test_limit_smaller_than_a_report(self):
+        ring = ringbuffer.ReportRing(100)
+        cursor = ring.cursor("test")
+        for n in (4, 9, 14): # 5 rows each
+            ring.put(numbered_report(n))
+        # reports never get split across reads, so each read gets one
+        for n in (4, 9, 14):
+            self.assertEqual(self.check_complete(cursor.reports(limit=2)), [n])
+        self.assertEqual(cursor.reports(limit=2), [])
+
+    def test_new_cursor_mid_report(self):
+        ring = ringbuffer.ReportRing(12)
+        for n in (4, 9, 14): # 15 rows, so the oldest left is partway into 4
+            ring.put(numbered_report(n))
+        cursor = ring.cursor("late") # starts at row 3, the oldest
+        self.assertEqual(self.check_complete(cursor.reports()), [9, 14])
+        self.assertEqual(cursor.lapped, 2) # the rest of report 4
+
+    def test_concurrent_writer(self):
+        ring = ringbuffer.ReportRing(64)
+        cursor = ring.cursor("test")
+        done = threading.Event()
+        def write():
+            for n in range(5000):
+                ring.put(numbered_report(n))
+            done.set()
+        writer = threading.Thread(target=write)
+        writer.start()
+        numbers = []
+        while not done.is_set() or cursor.pending():
+            numbers += self.check_complete(cursor.reports(limit=random.randint(1, 20)))
+        writer.join()
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertEqual(numbers[-1], 4999)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,7 +8,7 @@ setup(name="gsmws",
       url="http://cs.berkeley.edu/~shaddi",
       license='bsd',
       packages=['gsmws'],
-      scripts=['GSMWSControl'],
+      scripts=['GSMWSControl', 'GSMWSAggregator', 'GSMWSAnalyze', 'GSMWSSoak'],
       #data_files=[('/etc/', ['conf/foo.conf']),
       classifiers=[
         'Operating System :: POSIX',